@@ -0,0 +1,218 @@
+"""
+Batch mode: extraction of many PDFs with bounded concurrency.
+
+Documents run concurrently through main.main, each on its own thread. Every stage of a document waits for a slot of
+its stage's limit:
+    - upload: S3 uploads
+    - textract: in-flight Textract jobs, until their results are ready (--max-jobs). Page images of --png jobs are run by
+      one TextractJobManager shared by all documents, so its job slots and TPS limits hold across the batch
+    - nlp: CPU-bound sentence processing and relation extraction
+A document gives up its slot of one stage before it waits for the next, so documents never block each other across
+stages. A failed document is recorded and the others continue.
+
+S3 objects are named after a hash of their content (--content-keys), since documents of the same name can run at the
+same time. Outputs of each document are written to <output>/<document name>/ (with a _2, _3, ... suffix for documents of the same
+name in different directories), and a summary manifest with the status, stage
+timings and output files of every document to <output>/batch_manifest.json.
+
+Usage:
+    python main.py text pdfs/ output job_name --batch --max-uploads 4 --max-jobs 10 --max-nlp 1
+    python main.py text manifest.txt output job_name --batch
+"""
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import json
+import os
+import threading
+import time
+import traceback
+import boto3
+import main
+from cache import ResultCache
+
+#Concurrency limit of each stage reported by main.main
+STAGE_LIMITS = {'upload': 'upload', 'textract': 'textract', 'nlp': 'nlp', 'relations': 'nlp'}
+
+
+def list_documents(path):
+    """
+    List the PDFs of a batch
+    :param path: directory of PDFs, or manifest file with one PDF path per line (relative to the manifest, lines
+                 starting with # are skipped)
+    :return: list of PDF paths
+    """
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, name) for name in os.listdir(path) if name.lower().endswith('.pdf'))
+
+    documents = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                document = os.path.join(os.path.dirname(path), line)
+                if document not in documents: #Listed twice, extract once
+                    documents.append(document)
+    return documents
+
+
+def output_names(documents):
+    """
+    Return the name of the output directory of every document, adding a suffix to names already taken
+    :param documents: list of PDF paths
+    :return: list of unique names, in the order of the documents
+    """
+    stems = [os.path.splitext(os.path.basename(document))[0] for document in documents]
+    taken = set(stems)
+    names = []
+    used = set()
+    for stem in stems:
+        name = stem
+        suffix = 2
+        while name in used or (name != stem and name in taken):
+            name = f'{stem}_{suffix}'
+            suffix += 1
+        used.add(name)
+        names.append(name)
+    return names
+
+
+class StageLimiter:
+
+    def __init__(self, upload=4, textract=10, nlp=1):
+        """
+        :param upload: maximum number of concurrent uploads
+        :param textract: maximum number of in-flight Textract jobs
+        :param nlp: maximum number of documents in sentence processing and relation extraction
+        """
+        self.semaphores = {'upload': threading.Semaphore(upload),
+                           'textract': threading.Semaphore(textract),
+                           'nlp': threading.Semaphore(nlp)}
+
+
+class DocumentStages:
+
+    def __init__(self, limiter):
+        """
+        :param limiter: StageLimiter shared by all documents of the batch
+        """
+        self.limiter = limiter
+        self.held = None
+        self.stage = None
+        self.started = None
+        self.timings = {}
+
+    def enter(self, stage):
+        """
+        Progress callback of main.main. Releases the slot of the previous stage and waits for a slot of the next one
+        :param stage: stage name
+        :return: none
+        """
+        self.finish_stage()
+        limit = STAGE_LIMITS.get(stage)
+        if limit != self.held:
+            self.release()
+            if limit is not None:
+                self.limiter.semaphores[limit].acquire()
+                self.held = limit
+        self.stage = stage
+        self.started = time.perf_counter()
+
+    def finish_stage(self):
+        if self.stage is not None:
+            self.timings[self.stage] = self.timings.get(self.stage, 0.0) + time.perf_counter() - self.started
+            self.stage = None
+
+    def release(self):
+        if self.held is not None:
+            self.limiter.semaphores[self.held].release()
+            self.held = None
+
+    def close(self):
+        self.finish_stage()
+        self.release()
+
+
+def run_document(args, document, name, limiter, textract, s3, job_manager, result_cache):
+    """
+    Run the extraction of one document of a batch
+    :param args: parsed command line arguments of the batch
+    :param document: path of the PDF
+    :param name: name of the document's output directory, unique in the batch
+    :param limiter: StageLimiter shared by all documents of the batch
+    :param textract: boto3 Textract client
+    :param s3: boto3 S3 resource
+    :param job_manager: TextractJobManager shared by all documents of the batch
+    :param result_cache: ResultCache shared by all documents of the batch, None without a cache
+    :return: manifest entry of the document
+    """
+    document_args = copy.copy(args)
+    document_args.input = document
+    document_args.output = os.path.join(args.output, name)
+    #Documents of the same name run concurrently, so S3 objects are named after their content instead of their name
+    document_args.content_keys = True
+    os.makedirs(document_args.output, exist_ok=True)
+
+    stages = DocumentStages(limiter)
+    entry = {'input': document, 'output': document_args.output, 'status': 'succeeded', 'error': None}
+    start = time.time()
+    try:
+        main.main(document_args, textract=textract, s3=s3, progress=stages.enter, job_manager=job_manager,
+                  result_cache=result_cache)
+    except Exception as error:
+        entry['status'] = 'failed'
+        entry['error'] = ''.join(traceback.format_exception_only(type(error), error)).strip()
+        traceback.print_exc()
+    finally:
+        stages.close()
+
+    entry['seconds'] = time.time() - start
+    entry['stage_seconds'] = stages.timings
+    entry['outputs'] = sorted(os.listdir(document_args.output))
+    print(f"{entry['status']}: {document} ({entry['seconds']:.1f} s)")
+    return entry
+
+
+def run_batch(args):
+    """
+    Run the extraction of every document of a batch and write the summary manifest
+    :param args: parsed command line arguments, args.input is a directory of PDFs or a manifest file
+    :return: summary manifest
+    """
+    main.set_model_memory(args) #Once for the whole batch, the model registry is shared by all documents
+    documents = list_documents(args.input)
+    names = output_names(documents)
+    limiter = StageLimiter(upload=args.max_uploads, textract=args.max_jobs, nlp=args.max_nlp)
+    #boto3 clients are thread safe and shared by all documents
+    textract = boto3.client('textract', main.region_name)
+    s3 = boto3.resource('s3')
+    job_manager = main.make_job_manager(args, textract, main.make_completion_queue(args))
+    #One cache for all documents, so evictions of one document do not race with reads of another
+    result_cache = None if args.no_cache else ResultCache(directory=args.cache_dir, max_size=args.cache_size * 1024 ** 2)
+    os.makedirs(args.output, exist_ok=True)
+
+    #Enough threads to fill every stage, documents wait for their stage's slot
+    workers = args.max_uploads + args.max_jobs + args.max_nlp
+    start = time.time()
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            entries = list(pool.map(lambda document, name: run_document(args, document, name, limiter, textract, s3,
+                                                                        job_manager, result_cache),
+                                    documents, names))
+    finally:
+        job_manager.close()
+    elapsed = time.time() - start
+
+    succeeded = sum(entry['status'] == 'succeeded' for entry in entries)
+    summary = {'documents': len(entries),
+               'succeeded': succeeded,
+               'failed': len(entries) - succeeded,
+               'seconds': elapsed,
+               'documents_per_hour': succeeded / elapsed * 3600 if elapsed else 0.0,
+               'limits': {'upload': args.max_uploads, 'textract': args.max_jobs, 'nlp': args.max_nlp},
+               'entries': entries}
+    with open(os.path.join(args.output, 'batch_manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(summary, f, indent=2)
+
+    print(f"{succeeded}/{len(entries)} documents succeeded in {elapsed:.1f} s "
+          f"({summary['documents_per_hour']:.1f} documents/hour)")
+    return summary
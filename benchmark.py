@@ -0,0 +1,357 @@
+"""
+Benchmarks for the extraction workflow.
+
+Usage:
+    python benchmark.py startup [--runs 5]
+        Cold-start time of main.py for each mode, measured in fresh interpreters. Fails (exit code 1) if a mode goes
+        over its startup budget, or if importing main and parsing arguments loads any heavy module
+
+    python benchmark.py segmentation PAGES [--n-process 1] [--batch-size 8]
+        Sentence boundaries and pages/second of every segmentation mode, compared with the accurate (parser) mode.
+        PAGES is a text file or a directory of text files, with pages separated by form feeds
+
+    python benchmark.py ner SENTENCES_CSV [--token-budget 8192] [--backends pytorch onnx onnx-int8] [--baseline]
+        Sentences/second of the batched spaceroberta_CR inference engine with each backend on the 'inputs' column of
+        a Text.csv file, and how many sentences get the same entities as the PyTorch backend. With --baseline, also
+        runs the Transformers pipeline on the PyTorch model
+
+    python benchmark.py modifiers [--sentences 200] [--clauses 20] [--runs 5]
+        Time of the clausal_modifiers and PP_modifiers components on long nested sentences, against the previous list
+        based implementation. Fails (exit code 1) if any span differs
+
+    python benchmark.py triples SENTENCES_CSV [--reference OLD_RELATION_EXTRACTION_PY] [--runs 3]
+        Time of get_all_triples on the parsed 'inputs' column of a Text.csv file, with en_core_web_sm entities standing
+        in for the Transformer NER. With --reference, also times a previous relation_extraction.py, e.g.
+        `git show <revision>:relation_extraction.py > reference.py`, and fails (exit code 1) if any triple differs
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+#Cold-start budget in seconds for each mode, as main.py arguments
+STARTUP_BUDGETS = {
+    'table': (['table', 'input.pdf', 'output', 'job'], 1.5),
+    'table --png': (['table', 'input.pdf', 'output', 'job', '--png'], 2.0),
+    'text': (['text', 'input.pdf', 'output', 'job'], 6.0),
+    'text --relationships': (['text', 'input.pdf', 'output', 'job', '--relationships'], 12.0),
+}
+
+#Modules that must only be imported by the code paths that need them
+HEAVY_MODULES = ['spacy', 'textacy', 'transformers', 'torch', 'pdf2image', 'PyPDF2']
+
+STARTUP_SCRIPT = '''
+import json, sys, time
+start = time.perf_counter()
+import main
+args = main.parse_args(json.loads(sys.argv[1]))
+parsed = time.perf_counter()
+eager = [module for module in json.loads(sys.argv[2]) if module in sys.modules]
+main.import_dependencies(args)
+print(json.dumps({'parse': parsed - start, 'total': time.perf_counter() - start, 'eager': eager}))
+'''
+
+
+def measure_startup(argv):
+    """
+    Measure the cold start of main.py with the given arguments in a fresh interpreter
+    :param argv: main.py arguments
+    :return: dict with the time to parse arguments, the total time including the mode's imports, and any heavy
+             modules imported before the mode needed them
+    """
+    result = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT, json.dumps(argv), json.dumps(HEAVY_MODULES)],
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def benchmark_startup(runs=5):
+    """
+    Report the median cold-start time of every mode against its budget
+    :param runs: number of fresh interpreters per mode
+    :return: True if every mode is within budget
+    """
+    passed = True
+    print(f"{'mode':<24}{'parse (s)':>12}{'total (s)':>12}{'budget (s)':>12}")
+    for mode, (argv, budget) in STARTUP_BUDGETS.items():
+        results = [measure_startup(argv) for _ in range(runs)]
+        parse_time = statistics.median(result['parse'] for result in results)
+        total_time = statistics.median(result['total'] for result in results)
+        eager = sorted(set(module for result in results for module in result['eager']))
+
+        status = 'ok'
+        if total_time > budget:
+            status = 'OVER BUDGET'
+            passed = False
+        if eager:
+            status = f"eager imports: {', '.join(eager)}"
+            passed = False
+        print(f'{mode:<24}{parse_time:>12.2f}{total_time:>12.2f}{budget:>12.1f}  {status}')
+    return passed
+
+
+def read_pages(path):
+    """
+    Read page texts from a text file or every text file in a directory. Pages are separated by form feeds
+    :param path: file or directory
+    :return: list of page texts
+    """
+    paths = [path] if os.path.isfile(path) else sorted(os.path.join(path, name) for name in os.listdir(path)
+                                                       if name.endswith('.txt'))
+    pages = []
+    for file_path in paths:
+        with open(file_path, encoding='utf-8') as f:
+            pages.extend(page for page in f.read().split('\f') if page.strip())
+    return pages
+
+
+def sentence_ends(page_sentences, pages):
+    """
+    Return the character offsets where sentences end, as a set of (page index, offset)
+    """
+    ends = set()
+    for page_index, (sentences, page) in enumerate(zip(page_sentences, pages)):
+        offset = 0
+        for sentence in sentences:
+            offset = page.find(sentence, offset) + len(sentence)
+            ends.add((page_index, offset))
+    return ends
+
+
+def benchmark_segmentation(path, n_process=1, batch_size=8):
+    """
+    Compare the segmentation modes on the same pages
+    :param path: text file or directory of pages
+    :param n_process: number of processes used by nlp.pipe
+    :param batch_size: number of pages per batch
+    :return: none
+    """
+    from segmentation import SentenceSegmenter, SEGMENTATION_MODELS
+    from models import registry
+
+    pages = read_pages(path)
+    results = {}
+    for mode in SEGMENTATION_MODELS:
+        segmenter = SentenceSegmenter(mode, n_process=n_process, batch_size=batch_size)
+        registry.get(SEGMENTATION_MODELS[mode]) #Exclude model loading from the timing
+        start = time.perf_counter()
+        page_sentences = list(segmenter.segment(pages))
+        elapsed = time.perf_counter() - start
+        results[mode] = (page_sentences, elapsed)
+
+    reference = sentence_ends(results['accurate'][0], pages)
+    print(f"{'mode':<12}{'pages/s':>10}{'sentences':>12}{'precision':>12}{'recall':>10}{'f1':>8}")
+    for mode, (page_sentences, elapsed) in results.items():
+        ends = sentence_ends(page_sentences, pages)
+        matched = len(ends & reference)
+        precision = matched / len(ends) if ends else 0.0
+        recall = matched / len(reference) if reference else 0.0
+        f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+        sentences = sum(len(sentences) for sentences in page_sentences)
+        print(f'{mode:<12}{len(pages) / elapsed:>10.1f}{sentences:>12}{precision:>12.3f}{recall:>10.3f}{f1:>8.3f}')
+
+
+def entity_set(prediction):
+    return {(entity['entity_group'], entity['start'], entity['end']) for entity in prediction}
+
+
+def benchmark_ner(path, token_budget=8192, backends=('pytorch',), baseline=False):
+    """
+    Measure the throughput of batched NER inference
+    :param path: CSV file of sentences with header 'inputs'
+    :param token_budget: maximum number of tokens in a padded batch
+    :param backends: NER backends from models.NER_MODELS
+    :param baseline: also run the Transformers token-classification pipeline for comparison
+    :return: none
+    """
+    import pandas as pd
+    from models import registry, NER_MODELS
+    from ner_inference import NERInferenceEngine
+
+    sentences = [str(sentence) for sentence in pd.read_csv(path)['inputs'].values]
+    reference = None
+    for backend in backends:
+        model, tokenizer = registry.get(NER_MODELS[backend])
+        engine = NERInferenceEngine(model, tokenizer, token_budget=token_budget)
+        predictions = engine.predict(sentences)
+        summary = engine.summary()
+        if backend == 'pytorch':
+            reference = predictions
+        print(f"{backend:<10}{summary['sentences_per_second']:>10.1f} sentences/s, {summary['batches']} batches, "
+              f"{summary['windows'] - summary['sentences']} extra windows, {summary['padding']:.1%} padding")
+        if reference is not None and backend != 'pytorch':
+            identical = sum(entity_set(a) == entity_set(b) for a, b in zip(predictions, reference))
+            print(f'{"":<10}same entities as pytorch: {identical}/{len(sentences)} sentences')
+
+    if baseline:
+        from transformers import pipeline
+        model, tokenizer = registry.get(NER_MODELS['pytorch'])
+        inference_pipeline = pipeline(task='token-classification', model=model, tokenizer=tokenizer,
+                                      aggregation_strategy='simple')
+        start = time.perf_counter()
+        expected = inference_pipeline(sentences)
+        elapsed = time.perf_counter() - start
+        print(f"{'pipeline':<10}{len(sentences) / elapsed:>10.1f} sentences/s")
+        if reference is not None:
+            identical = sum(entity_set(a) == entity_set(b) for a, b in zip(reference, expected))
+            print(f'{"":<10}same entities as the engine: {identical}/{len(sentences)} sentences')
+
+
+MODIFIER_CLAUSE = ('the instrument that is mounted on the bracket of the optical bench, which is cooled by the '
+                   'radiator in the shadow of the spacecraft bus during the science phase of the mission')
+
+
+def reference_modifiers(doc):
+    """
+    Previous implementation of the clausal_modifiers and PP_modifiers components
+    :return: (clausal modifier bounds, PP modifier bounds)
+    """
+    clausal_mods = []
+    for token in doc:
+        if token.dep_ in ['relcl', 'advcl', 'acl']:
+            clausal_mods.append((token.left_edge.i, token.right_edge.i + 1))
+    clausal_mod_indices = [i for start, end in clausal_mods for i in range(start, end)]
+    PP_mods = []
+    for token in doc:
+        if token.dep_ == 'prep':
+            PP_indices = [tok.i for tok in list(token.subtree) if tok.i not in clausal_mod_indices]
+            if PP_indices:
+                PP_mods.append((PP_indices[0], PP_indices[-1] + 1))
+    return clausal_mods, PP_mods
+
+
+def benchmark_modifiers(sentences=200, clauses=20, runs=5):
+    """
+    Compare the modifier components with the previous implementation on long parsed sentences
+    :param sentences: number of sentences
+    :param clauses: number of nested clauses per sentence
+    :param runs: number of timed runs, the best run is reported
+    :return: True if both implementations produce the same spans
+    """
+    from models import registry
+    from relation_pipeline import RelationsPipeline
+
+    nlp = registry.get('en_core_web_sm')
+    text = 'The ' + ', and '.join([MODIFIER_CLAUSE] * clauses) + ' shall operate within the specified range.'
+    docs = list(nlp.pipe([text] * sentences))
+    print(f'{sentences} sentences of {len(docs[0])} tokens')
+
+    def best_time(function):
+        times = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            for doc in docs:
+                function(doc)
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    def components(doc):
+        RelationsPipeline.PP_modifiers(RelationsPipeline.clausal_modifiers(doc))
+
+    reference_time = best_time(reference_modifiers)
+    components_time = best_time(components)
+    print(f'reference:  {reference_time:.3f} s')
+    print(f'components: {components_time:.3f} s ({reference_time / components_time:.1f}x)')
+
+    identical = True
+    for doc in docs:
+        clausal_mods, PP_mods = reference_modifiers(doc)
+        identical &= [(span.start, span.end) for span in doc.spans['clausal_mods']] == clausal_mods
+        identical &= [(span.start, span.end) for span in doc.spans['PP_mods']] == PP_mods
+    print('identical spans' if identical else 'SPANS DIFFER')
+    return identical
+
+
+def benchmark_triples(path, reference=None, runs=3):
+    """
+    Time triple extraction on parsed sentences
+    :param path: CSV file of sentences with header 'inputs'
+    :param reference: path of a previous relation_extraction.py to compare with, None to only time the current one
+    :param runs: number of timed runs, the best run is reported
+    :return: True if the triples of both implementations are identical
+    """
+    import importlib.util
+    import pandas as pd
+    import spacy
+    import relation_extraction
+    import relation_pipeline #Registers the modifier components
+
+    nlp = spacy.load('en_core_web_sm')
+    nlp.add_pipe('clausal_modifiers')
+    nlp.add_pipe('PP_modifiers')
+    sentences = [str(sentence) for sentence in pd.read_csv(path)['inputs'].values]
+    docs = list(nlp.pipe(sentences))
+
+    def run(module):
+        times = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            triples = [module.get_all_triples(doc) for doc in docs]
+            times.append(time.perf_counter() - start)
+        return min(times), triples
+
+    def rows(triples):
+        return [None if doc_triples is None else
+                [(subj.start, subj.end, verb, obj.start, obj.end, None if mod is None else (mod.start, mod.end))
+                 for subj, verb, obj, mod in doc_triples]
+                for doc_triples in triples]
+
+    current_time, current = run(relation_extraction)
+    print(f'{len(docs)} sentences, {sum(len(doc_triples or []) for doc_triples in current)} triples')
+    print(f'current:   {current_time:.3f} s ({len(docs) / current_time:.0f} sentences/s)')
+    if reference is None:
+        return True
+
+    spec = importlib.util.spec_from_file_location('reference_relation_extraction', reference)
+    reference_module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(reference_module)
+    reference_time, expected = run(reference_module)
+    print(f'reference: {reference_time:.3f} s ({len(docs) / reference_time:.0f} sentences/s)')
+    identical = rows(current) == rows(expected)
+    print('identical triples' if identical else 'TRIPLES DIFFER')
+    return identical
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    startup_parser = subparsers.add_parser('startup')
+    startup_parser.add_argument('--runs', type=int, default=5)
+
+    segmentation_parser = subparsers.add_parser('segmentation')
+    segmentation_parser.add_argument('pages')
+    segmentation_parser.add_argument('--n-process', dest='n_process', type=int, default=1)
+    segmentation_parser.add_argument('--batch-size', dest='batch_size', type=int, default=8)
+
+    ner_parser = subparsers.add_parser('ner')
+    ner_parser.add_argument('sentences')
+    ner_parser.add_argument('--token-budget', dest='token_budget', type=int, default=8192)
+    ner_parser.add_argument('--backends', nargs='+', choices=['pytorch', 'onnx', 'onnx-int8'], default=['pytorch'])
+    ner_parser.add_argument('--baseline', action='store_true', default=False)
+
+    modifiers_parser = subparsers.add_parser('modifiers')
+    modifiers_parser.add_argument('--sentences', type=int, default=200)
+    modifiers_parser.add_argument('--clauses', type=int, default=20)
+    modifiers_parser.add_argument('--runs', type=int, default=5)
+
+    triples_parser = subparsers.add_parser('triples')
+    triples_parser.add_argument('sentences')
+    triples_parser.add_argument('--reference')
+    triples_parser.add_argument('--runs', type=int, default=3)
+
+    args = parser.parse_args()
+
+    if args.benchmark == 'startup':
+        sys.exit(0 if benchmark_startup(runs=args.runs) else 1)
+    if args.benchmark == 'segmentation':
+        benchmark_segmentation(args.pages, n_process=args.n_process, batch_size=args.batch_size)
+    if args.benchmark == 'ner':
+        benchmark_ner(args.sentences, token_budget=args.token_budget, backends=args.backends,
+                      baseline=args.baseline)
+    if args.benchmark == 'modifiers':
+        sys.exit(0 if benchmark_modifiers(sentences=args.sentences, clauses=args.clauses, runs=args.runs) else 1)
+    if args.benchmark == 'triples':
+        sys.exit(0 if benchmark_triples(args.sentences, reference=args.reference, runs=args.runs) else 1)
@@ -0,0 +1,111 @@
+"""
+Streaming store of the Textract blocks of a job, built once across all pages of results.
+
+Relationships in a Textract response can point at blocks returned on a later page of results (e.g. the CELL and WORD
+children of a TABLE), so tables are only assembled after every response page was ingested.
+
+Storage is kept compact for large documents:
+    - Block Ids are interned to consecutive integers when first seen, either as a block or as a child reference
+    - Parent -> children relationships are stored as integer arrays
+    - Only the block fields used downstream are kept, geometry is dropped
+"""
+from array import array
+from collections import defaultdict
+
+#Block fields kept by the store
+BLOCK_FIELDS = ['BlockType', 'Text', 'Page', 'Confidence', 'RowIndex', 'ColumnIndex', 'RowSpan', 'ColumnSpan',
+                'SelectionStatus', 'EntityTypes']
+
+
+class BlockStore:
+
+    def __init__(self):
+        self.index = {} #Textract block Id -> interned integer id
+        self.blocks = [] #Interned id -> block fields, None until the block itself is ingested
+        self.children = [] #Interned id -> array of interned child ids, None for blocks without children
+        self.by_type = defaultdict(lambda: array('l')) #BlockType -> interned ids in ingestion order
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def intern(self, block_id):
+        """
+        Return the integer id of a block Id, allocating one if the Id was not seen yet
+        :param block_id: Textract block Id
+        :return: interned id
+        """
+        i = self.index.get(block_id)
+        if i is None:
+            i = len(self.blocks)
+            self.index[block_id] = i
+            self.blocks.append(None)
+            self.children.append(None)
+        return i
+
+    def add_block(self, block):
+        """
+        Add a single Textract block
+        :param block: block from a Textract response
+        :return: interned id of the block
+        """
+        i = self.intern(block['Id'])
+        self.blocks[i] = {field: block[field] for field in BLOCK_FIELDS if field in block}
+        self.by_type[block['BlockType']].append(i)
+
+        for relationship in block.get('Relationships', []):
+            if relationship['Type'] == 'CHILD':
+                child_ids = array('l', [self.intern(child_id) for child_id in relationship['Ids']])
+                if self.children[i] is None:
+                    self.children[i] = child_ids
+                else:
+                    self.children[i].extend(child_ids)
+        return i
+
+    def ingest(self, response):
+        """
+        Add all blocks of a Textract response page
+        :param response: response of get_document_analysis / get_document_text_detection
+        :return: none
+        """
+        for block in response['Blocks']:
+            self.add_block(block)
+
+    def get(self, i):
+        """
+        Return the fields of a block
+        :param i: interned id
+        :return: dict of block fields, None if the block was referenced but never returned by Textract
+        """
+        return self.blocks[i]
+
+    def get_by_id(self, block_id):
+        """
+        Return the fields of a block by its Textract Id
+        :param block_id: Textract block Id
+        :return: dict of block fields, None if the block is unknown
+        """
+        i = self.index.get(block_id)
+        return None if i is None else self.blocks[i]
+
+    def child_ids(self, i):
+        """
+        Return the interned ids of the CHILD blocks of a block
+        :param i: interned id
+        :return: array of interned ids
+        """
+        return self.children[i] if self.children[i] is not None else ()
+
+    def of_type(self, block_type):
+        """
+        Return the interned ids of all blocks of a type, in the order they were returned by Textract
+        :param block_type: Textract BlockType, e.g. 'TABLE'
+        :return: array of interned ids
+        """
+        return self.by_type.get(block_type, ())
+
+    def missing(self):
+        """
+        Count blocks that were referenced as children but never returned by Textract
+        :return: number of missing blocks
+        """
+        return sum(1 for block in self.blocks if block is None)
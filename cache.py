@@ -0,0 +1,132 @@
+"""
+Local content-addressed cache of raw Textract results.
+
+Entries are keyed by the SHA-256 of the input PDF, the page range, the extraction mode and the feature types, so
+re-running the same document with different downstream options skips both the S3 upload and the Textract job.
+Each entry stores the paginated Get* responses as gzip-compressed JSON lines, one response per line. Entries are
+evicted least recently used first once the cache grows beyond its size limit. Jobs of one process share one
+ResultCache, whose lock serializes evictions. Entries removed by another process while they are read are treated as
+cache misses.
+"""
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+
+def sha256_file(fileobj):
+    """
+    Return the SHA-256 hex digest of a binary file object, read in chunks from its current position
+    :param fileobj: binary file object
+    :return: hex digest
+    """
+    file_hash = hashlib.sha256()
+    for chunk in iter(lambda: fileobj.read(1024 ** 2), b''):
+        file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+class ResultCache:
+
+    def __init__(self, directory='.textract_cache', max_size=2 * 1024 ** 3):
+        """
+        :param directory: directory holding the cache entries
+        :param max_size: maximum total size of the cache entries in bytes
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def make_key(path, page_range, mode, feature_types=None):
+        """
+        Return the cache key of a document
+        :param path: path of the input PDF
+        :param page_range: tuple of (start, stop) pages, None for the whole document
+        :param mode: 'table' or 'text'
+        :param feature_types: Textract feature types of the job
+        :return: hex digest identifying the Textract result
+        """
+        with open(path, 'rb') as f:
+            file_hash = sha256_file(f)
+
+        key = {'sha256': file_hash,
+               'page_range': list(page_range) if page_range else None,
+               'mode': mode,
+               'feature_types': sorted(feature_types) if feature_types and mode == 'table' else None}
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.directory, key + '.jsonl.gz')
+
+    def __contains__(self, key):
+        return key is not None and os.path.exists(self.entry_path(key))
+
+    def read(self, key):
+        """
+        Open an entry and return its cached Textract responses. The entry stays readable once opened, even if it is
+        evicted while its responses are read
+        :param key: cache key
+        :return: generator of responses, None if the entry is not in the cache
+        """
+        path = self.entry_path(key)
+        try:
+            os.utime(path) #Mark the entry as recently used
+            f = gzip.open(path, 'rt', encoding='utf-8')
+        except FileNotFoundError:
+            return None
+        return self.iter_responses(f)
+
+    @staticmethod
+    def iter_responses(f):
+        with f:
+            for line in f:
+                yield json.loads(line)
+
+    def write(self, key, responses):
+        """
+        Pass Textract responses through while storing them. The entry is only added once all responses were read
+        :param key: cache key
+        :param responses: iterable of Textract responses
+        :return: generator of the same responses
+        """
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as raw, gzip.open(raw, 'wt', encoding='utf-8') as f:
+                for response in responses:
+                    response = {name: value for name, value in response.items() if name != 'ResponseMetadata'}
+                    f.write(json.dumps(response) + '\n')
+                    yield response
+            os.replace(temp_path, self.entry_path(key))
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        self.evict()
+
+    def evict(self):
+        """
+        Delete the least recently used entries until the cache fits in max_size
+        :return: none
+        """
+        with self.lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                if name.endswith('.jsonl.gz'):
+                    try:
+                        stat = os.stat(os.path.join(self.directory, name))
+                    except FileNotFoundError: #Evicted by another process
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, name))
+
+            total_size = sum(size for _, size, _ in entries)
+            for _, size, name in sorted(entries):
+                if total_size <= self.max_size:
+                    break
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+                total_size -= size
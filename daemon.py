@@ -0,0 +1,252 @@
+"""
+Long-running extraction daemon with a local HTTP job API.
+
+The daemon keeps models warm in its model registry and runs submitted jobs with main.main on a worker pool, so jobs
+do not pay for Python startup, imports and model loads.
+
+API (JSON):
+    POST /jobs                  submit a job, body {"argv": [<main.py arguments>], "cwd": <directory of relative paths>}
+    GET  /jobs                  list all jobs
+    GET  /jobs/<id>             status and progress of a job
+    POST /jobs/<id>/cancel      cancel a queued job, or a running job before its next stage
+    GET  /health                loaded models and number of jobs
+
+Usage:
+    python daemon.py --port 8765 --workers 2 --warm-up [--max-model-memory MB]
+    python main.py text input.pdf output job_name --relationships --daemon http://127.0.0.1:8765 --wait
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
+import os
+import threading
+import time
+import traceback
+import uuid
+import boto3
+import main
+from models import registry, TEXT_MODELS, RELATION_MODELS
+
+#Stages reported by main.main, in order
+STAGES = ['queued', 'upload', 'textract', 'nlp', 'relations', 'done']
+
+
+class Job:
+
+    def __init__(self, args):
+        self.id = uuid.uuid4().hex
+        self.args = args
+        self.status = 'queued'
+        self.stage = 'queued'
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cancel_event = threading.Event()
+        self.lock = threading.Lock() #Guards the change from queued to running or cancelled
+        self.future = None
+
+    def set_stage(self, stage):
+        self.stage = stage
+
+    def to_dict(self):
+        return {'id': self.id,
+                'status': self.status,
+                'stage': self.stage,
+                'progress': STAGES.index(self.stage) / (len(STAGES) - 1) if self.stage in STAGES else None,
+                'mode': self.args.mode,
+                'input': self.args.input,
+                'job_name': self.args.job_name,
+                'error': self.error,
+                'submitted_at': self.submitted_at,
+                'started_at': self.started_at,
+                'finished_at': self.finished_at}
+
+
+class ExtractionDaemon:
+
+    def __init__(self, workers=2):
+        """
+        :param workers: number of jobs run concurrently
+        """
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.jobs = {}
+        self.lock = threading.Lock()
+        #boto3 clients are thread safe and shared by all jobs
+        self.textract = boto3.client('textract', main.region_name)
+        self.s3 = boto3.resource('s3')
+
+    def submit(self, argv, cwd=None):
+        """
+        Queue a job
+        :param argv: main.py command line arguments
+        :param cwd: directory that relative paths in argv are relative to
+        :return: Job
+        """
+        args = main.parse_args(argv)
+        #The model registry is shared by all running jobs, so its ceiling is only set when the daemon starts
+        if args.max_model_memory is not None and args.max_model_memory * 1024 ** 2 != registry.max_memory:
+            raise Exception('The model memory ceiling is set when the daemon starts (daemon.py --max-model-memory)')
+        if cwd is not None:
+            args.input = os.path.join(cwd, args.input)
+            args.output = os.path.join(cwd, args.output)
+            args.cache_dir = os.path.join(cwd, args.cache_dir)
+            args.inference_cache = os.path.join(cwd, args.inference_cache)
+            args.relation_store = os.path.join(cwd, args.relation_store)
+
+        job = Job(args)
+        with self.lock:
+            self.jobs[job.id] = job
+        job.future = self.pool.submit(self.run, job)
+        return job
+
+    def run(self, job):
+        """
+        Run a job on a worker thread
+        :param job: Job
+        :return: none
+        """
+        with job.lock:
+            if job.status != 'queued': #Cancelled before a worker picked it up
+                return
+            if job.cancel_event.is_set():
+                job.status = 'cancelled'
+                job.finished_at = time.time()
+                return
+            job.status = 'running'
+            job.started_at = time.time()
+        try:
+            main.main(job.args, textract=self.textract, s3=self.s3, progress=job.set_stage,
+                      cancel_event=job.cancel_event)
+            job.status = 'succeeded'
+            job.stage = 'done'
+        except main.JobCancelled:
+            job.status = 'cancelled'
+        except Exception as error:
+            job.status = 'failed'
+            job.error = ''.join(traceback.format_exception_only(type(error), error)).strip()
+            traceback.print_exc()
+        finally:
+            job.finished_at = time.time()
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    def cancel(self, job_id):
+        """
+        Cancel a job. Queued jobs never start, running jobs stop before their next stage
+        :param job_id: job ID
+        :return: Job, None if the job is unknown
+        """
+        job = self.get(job_id)
+        if job is None:
+            return None
+        with job.lock:
+            job.cancel_event.set()
+            #A queued job is cancelled here, whether or not a worker already picked it up. A running job stops with
+            #JobCancelled before its next stage
+            if job.status == 'queued':
+                job.status = 'cancelled'
+                job.finished_at = time.time()
+        job.future.cancel()
+        return job
+
+
+def make_handler(daemon):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def send_json(self, status, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def read_json(self):
+            length = int(self.headers.get('Content-Length', 0))
+            return json.loads(self.rfile.read(length) or b'{}')
+
+        def do_GET(self):
+            parts = self.path.strip('/').split('/')
+            if parts == ['health']:
+                self.send_json(200, {'models': registry.loaded(), 'jobs': len(daemon.list())})
+            elif parts == ['jobs']:
+                self.send_json(200, [job.to_dict() for job in daemon.list()])
+            elif len(parts) == 2 and parts[0] == 'jobs':
+                job = daemon.get(parts[1])
+                if job is None:
+                    self.send_json(404, {'error': 'Unknown job'})
+                else:
+                    self.send_json(200, job.to_dict())
+            else:
+                self.send_json(404, {'error': 'Not found'})
+
+        def do_POST(self):
+            parts = self.path.strip('/').split('/')
+            if parts == ['jobs']:
+                try:
+                    body = self.read_json()
+                    job = daemon.submit(body['argv'], cwd=body.get('cwd'))
+                except (Exception, SystemExit) as error: #argparse exits on invalid arguments
+                    self.send_json(400, {'error': str(error)})
+                    return
+                self.send_json(202, job.to_dict())
+            elif len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'cancel':
+                job = daemon.cancel(parts[1])
+                if job is None:
+                    self.send_json(404, {'error': 'Unknown job'})
+                else:
+                    self.send_json(200, job.to_dict())
+            else:
+                self.send_json(404, {'error': 'Not found'})
+
+    return Handler
+
+
+def serve(host='127.0.0.1', port=8765, workers=2, warm_up=False, max_model_memory=None):
+    """
+    Run the daemon until interrupted
+    :param host: interface to listen on
+    :param port: port to listen on
+    :param workers: number of jobs run concurrently
+    :param warm_up: load all models before accepting jobs
+    :param max_model_memory: memory ceiling for loaded models in MB, shared by all jobs
+    :return: none
+    """
+    if max_model_memory is not None:
+        registry.max_memory = max_model_memory * 1024 ** 2
+    if warm_up:
+        registry.warm_up(TEXT_MODELS + RELATION_MODELS)
+
+    daemon = ExtractionDaemon(workers=workers)
+    server = ThreadingHTTPServer((host, port), make_handler(daemon))
+    print(f'Extraction daemon listening on http://{host}:{port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        daemon.pool.shutdown(wait=False, cancel_futures=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--warm-up', action='store_true', dest='warm_up', default=False)
+    parser.add_argument('--max-model-memory', dest='max_model_memory', type=int,
+                        help='Memory ceiling for loaded models in MB, shared by all jobs')
+    args = parser.parse_args()
+
+    serve(host=args.host, port=args.port, workers=args.workers, warm_up=args.warm_up,
+          max_model_memory=args.max_model_memory)
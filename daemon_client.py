@@ -0,0 +1,60 @@
+"""
+Client for the extraction daemon's local HTTP job API. Only uses the standard library, so submitting a job does not
+import any of the extraction or NLP modules.
+"""
+import json
+import os
+import time
+import urllib.error
+import urllib.request
+
+
+def request_json(url, body=None):
+    data = json.dumps(body).encode('utf-8') if body is not None else None
+    request = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'},
+                                     method='POST' if data is not None else 'GET')
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def error_message(error):
+    """
+    Return the error message of a request the daemon rejected
+    :param error: urllib.error.HTTPError raised by request_json
+    :return: the daemon's error message, or the HTTP status if the response has none
+    """
+    try:
+        return json.loads(error.read())['error']
+    except (ValueError, KeyError, TypeError):
+        return f'HTTP {error.code} {error.reason}'
+
+
+def submit_job(url, argv, cwd=None):
+    """
+    Submit a job to a running daemon
+    :param url: base URL of the daemon
+    :param argv: main.py command line arguments
+    :param cwd: directory that relative paths in argv are relative to, defaults to the current directory
+    :return: job status dict
+    """
+    return request_json(url.rstrip('/') + '/jobs', {'argv': argv, 'cwd': cwd or os.getcwd()})
+
+
+def get_job(url, job_id):
+    return request_json(f"{url.rstrip('/')}/jobs/{job_id}")
+
+
+def cancel_job(url, job_id):
+    return request_json(f"{url.rstrip('/')}/jobs/{job_id}/cancel", {})
+
+
+def wait_for_job(url, job_id, interval=2):
+    """
+    Poll a job until it is no longer queued or running
+    :return: final job status dict
+    """
+    job = get_job(url, job_id)
+    while job['status'] in ['queued', 'running']:
+        time.sleep(interval)
+        job = get_job(url, job_id)
+    return job
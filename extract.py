@@ -3,11 +3,13 @@ Extract tables or text using Amazon Textract into CSV files.
 Tables on separate pages are treated as different tables. Multipage tables will be split up within the csv.
 
 Table extraction workflow:
-    1. Return all detected table cells on a single page as a string
-    2. Write each string to CSV along with table ID and page number
+    1. Ingest the blocks of every page of results into a BlockStore indexed by Id and BlockType
+    2. Return all detected table cells as a string, one table at a time
+    3. Write each string to CSV along with the page number
+    With structured tables, tables are filled into grids, stitched across pages and written by the tables module
 
-Text extraction workflow:
-    1. Return raw text split by page
+Text extraction workflow (pages are streamed through every step):
+    1. Return raw text split by page, as soon as each page is complete
     2. Normalize text using Textacy preprocessing pipeline
     3. Segment each page's text into sentences
     4. Pass each sentence into a trained 'sentence relevance' classification model for postprocessing.
@@ -17,15 +19,66 @@ Text extraction workflow:
     5. Write relevant sentences into CSV file
 """
 import time
-import spacy
-from textacy.preprocessing import pipeline, normalize, remove
 import csv
+import re
+from itertools import islice
+from collections import deque
+from job_manager import poll_delay, SUCCESS_STATUSES
+from blocks import BlockStore
+from pagination import PrefetchPaginator
+from models import registry
+from inference_cache import model_fingerprint, file_signature
+from segmentation import SentenceSegmenter
+from tables import cell_text, get_tables, write_tables_csv, write_cells_parquet
 
 class Textract:
 
-    def __init__(self, bucket, textract_client):
+    def __init__(self, bucket, textract_client, completion_queue=None, notification_timeout=600, cache=None,
+                 feature_types=None, structured_tables=False, stitch_tables=True, tables_parquet=False,
+                 inference_cache=None, segmenter=None):
+        """
+        :param bucket: S3 bucket holding the documents
+        :param textract_client: boto3 Textract client
+        :param completion_queue: CompletionQueue receiving job completion messages, None to poll job statuses
+        :param notification_timeout: seconds to wait for a completion message before falling back to polling
+        :param cache: ResultCache of raw Textract results, None to always run a Textract job
+        :param feature_types: feature types for table extraction jobs
+        :param structured_tables: write one quoted CSV file per table (with row/column spans) instead of a single CSV
+        :param stitch_tables: merge structured tables that continue across pages
+        :param tables_parquet: also write all structured table cells into a Parquet file
+        :param inference_cache: InferenceCache of sentence relevance scores, None to score every sentence
+        :param segmenter: SentenceSegmenter for extracted text, None for the parser-based segmenter
+        """
         self.bucket = bucket
         self.textract = textract_client
+        self.completion_queue = completion_queue
+        self.notification_timeout = notification_timeout
+        self.cache = cache
+        self.feature_types = feature_types or ['TABLES']
+        self.structured_tables = structured_tables
+        self.stitch_tables = stitch_tables
+        self.tables_parquet = tables_parquet
+        self.inference_cache = inference_cache
+        self.segmenter = segmenter or SentenceSegmenter('accurate')
+
+    def open_cached(self, cache_key):
+        """
+        Open the cached Textract result of a cache key. An opened result stays readable even if the cache evicts it
+        :param cache_key: key from ResultCache.make_key
+        :return: generator of the cached responses, None if the result is not cached
+        """
+        if self.cache is None or cache_key is None:
+            return None
+        return self.cache.read(cache_key)
+
+    def notification_kwargs(self):
+        """
+        NotificationChannel argument for the Start* calls if a completion queue is configured
+        :return: dict of keyword arguments
+        """
+        if self.completion_queue is None or self.completion_queue.notification_channel is None:
+            return {}
+        return {'NotificationChannel': self.completion_queue.notification_channel}
 
     #Start job for table extraction
     def DocumentAnalysis(self):
@@ -34,8 +87,10 @@ class Textract:
         :return: none
         """
         response = self.textract.start_document_analysis(DocumentLocation={'S3Object': {'Bucket': self.bucket, 'Name': self.document}},
-                                                             FeatureTypes=["TABLES"])
+                                                             FeatureTypes=self.feature_types, **self.notification_kwargs())
         self.jobId = str(response['JobId'])
+        if self.completion_queue is not None:
+            self.completion_queue.expect(self.jobId)
 
     #Start job for text extraction
     def DocumentTextDetection(self):
@@ -43,137 +98,127 @@ class Textract:
         Start Textract job for text extraction
         :return: none
         """
-        response = self.textract.start_document_text_detection(DocumentLocation={'S3Object': {'Bucket': self.bucket, 'Name': self.document}})
+        response = self.textract.start_document_text_detection(DocumentLocation={'S3Object': {'Bucket': self.bucket, 'Name': self.document}},
+                                                               **self.notification_kwargs())
         self.jobId = str(response['JobId'])
+        if self.completion_queue is not None:
+            self.completion_queue.expect(self.jobId)
 
     def WaitForJob(self):
         """
-        Wait for job to finish
+        Wait for job to finish. Waits on the completion queue if one is configured, otherwise (or if the completion
+        message does not arrive in time) polls with an adaptive backoff based on the page count of the document
         :return: none
         """
+        status = 'IN_PROGRESS'
+        response = {}
+        if self.completion_queue is not None:
+            message = self.completion_queue.wait_for(self.jobId, timeout=self.notification_timeout)
+            if message is not None:
+                status = message['Status']
+                response = message
 
         if self.mode == 'table':
-            time.sleep(5)
-            response = self.textract.get_document_analysis(JobId=self.jobId)
-            status = response['JobStatus']
-            while status == 'IN_PROGRESS':
-                time.sleep(5)
-                response = self.textract.get_document_analysis(JobId=self.jobId)
-                status = response['JobStatus']
-
+            get_status = self.textract.get_document_analysis
         if self.mode == 'text':
-            time.sleep(5)
-            response = self.textract.get_document_text_detection(JobId=self.jobId)
+            get_status = self.textract.get_document_text_detection
+
+        attempt = 0
+        while status == 'IN_PROGRESS':
+            time.sleep(poll_delay(attempt, self.pages))
+            response = get_status(JobId=self.jobId, MaxResults=1)
             status = response['JobStatus']
-            while status == 'IN_PROGRESS':
-                time.sleep(5)
-                response = self.textract.get_document_text_detection(JobId=self.jobId)
-                status = response['JobStatus']
+            attempt += 1
+
+        if status not in SUCCESS_STATUSES:
+            raise Exception(f'Textract job {self.jobId} failed: {response.get("StatusMessage")}')
 
-    def get_rows_columns_map(self, table_result, blocks_map):
+    def get_rows_columns_map(self, table_id, store):
         rows = {}
-        for relationship in table_result['Relationships']:
-            if relationship['Type'] == 'CHILD':
-                for child_id in relationship['Ids']:
-                    try:
-                        cell = blocks_map[child_id]
-                        if cell['BlockType'] == 'CELL':
-                            row_index = cell['RowIndex']
-                            col_index = cell['ColumnIndex']
-                            if row_index not in rows:
-                                # create new row
-                                rows[row_index] = {}
-
-                            # get the text value
-                            rows[row_index][col_index] = self.get_cell_text(cell, blocks_map)
-                    except KeyError:
-                        print("Error extracting Table data - {}:".format(KeyError))
-                        pass
+        for child_id in store.child_ids(table_id):
+            cell = store.get(child_id)
+            if cell is None:
+                print("Error extracting Table data - block missing from Textract results")
+                continue
+            if cell['BlockType'] == 'CELL':
+                row_index = cell['RowIndex']
+                col_index = cell['ColumnIndex']
+                if row_index not in rows:
+                    # create new row
+                    rows[row_index] = {}
+
+                # get the text value
+                rows[row_index][col_index] = self.get_cell_text(child_id, store)
         return rows
 
-    def get_cell_text(self, result, blocks_map):
-        text = ''
-        if 'Relationships' in result:
-            for relationship in result['Relationships']:
-                if relationship['Type'] == 'CHILD':
-                    for child_id in relationship['Ids']:
-                        try:
-                            word = blocks_map[child_id]
-                            if word['BlockType'] == 'WORD':
-                                text += word['Text'] + ' '
-                            if word['BlockType'] == 'SELECTION_ELEMENT':
-                                if word['SelectionStatus'] == 'SELECTED':
-                                    text += 'X '
-                        except KeyError:
-                            print("Error extracting Table data - {}:".format(KeyError))
-
-        return text
-
-    def get_table_csv_results(self, blocks):
-
-        blocks_map = {}
-        table_blocks = []
-        for block in blocks:
-            blocks_map[block['Id']] = block
-            if block['BlockType'] == "TABLE":
-                table_blocks.append(block)
-
-        if len(table_blocks) <= 0:
-            return "<b> NO Table FOUND </b>"
+    def get_cell_text(self, cell_id, store):
+        return cell_text(cell_id, store)
 
-        csv = ''
-        for table in table_blocks:
-            csv += self.generate_table_csv(table, blocks_map, table['Page'])
-            csv += '\n\n'
+    def get_table_csv_results(self, store):
 
-        return csv
+        table_ids = store.of_type('TABLE')
 
-    def generate_table_csv(self, table_result, blocks_map, table_page):
-        rows = self.get_rows_columns_map(table_result, blocks_map)
+        if len(table_ids) <= 0:
+            return "<b> NO Table FOUND </b>"
+
+        table_csvs = []
+        for table_id in table_ids:
+            table_csvs.append(self.generate_table_csv(table_id, store, store.get(table_id)['Page']))
+            table_csvs.append('\n\n')
+
+        return ''.join(table_csvs)
 
-        csv = f'Page:{table_page}\n\n'
+    def generate_table_csv(self, table_id, store, table_page):
+        rows = self.get_rows_columns_map(table_id, store)
 
+        #Legacy layout: every cell followed by a comma, commas inside cells replaced with semicolons so a cell is not
+        #split. Quoted cells are written with --structured-tables
+        lines = [f'Page:{table_page}\n\n']
         for row_index, cols in rows.items():
+            lines.append(''.join(text.replace(',', ';') + ',' for text in cols.values()) + '\n')
+        lines.append('\n\n\n')
+        return ''.join(lines)
 
-            for col_index, text in cols.items():
-                text_no_comma = text.replace(',',';') #replace commas with semicolons so text cell is not split in csv
-                csv += f'{text_no_comma}' + ","
-            csv += '\n'
+    def GetResultPages(self):
+        """
+        Return every page of results of the finished job. The next page is prefetched on a background thread while
+        the current one is parsed, per-page timings are kept on self.paginator
+        :return: PrefetchPaginator over the Textract responses
+        """
+        if self.mode == 'table':
+            get_results = self.textract.get_document_analysis
+        if self.mode == 'text':
+            get_results = self.textract.get_document_text_detection
 
-        csv += '\n\n\n'
-        return csv
+        self.paginator = PrefetchPaginator(get_results, self.jobId, max_results=1000)
+        return self.paginator
 
     #Return all tables detected by Textract in a CSV
     def GetTablesCSV(self):
         """
-        Return all tables detected by Textract in a CSV
+        Return all tables detected by Textract in a CSV. Blocks of every response page are ingested into one
+        BlockStore first, so tables whose cells are returned on a later page of results are assembled completely
         :return:
         """
-        self.WaitForJob()
-
-        paginationToken = None
-        finished = False
+        tables = []
 
-        while finished == False:
+        store = BlockStore()
+        for response in self.responses:
+            store.ingest(response)
 
-            response = None
-            tables = []
+        if self.structured_tables:
+            output_prefix = re.sub(r'\.csv$', '', self.output_csv_path)
+            tables = get_tables(store, stitch=self.stitch_tables)
+            write_tables_csv(tables, output_prefix)
+            if self.tables_parquet:
+                write_cells_parquet(tables, output_prefix + '_Cells.parquet')
+            return tables
 
-            if paginationToken == None:
-                response = self.textract.get_document_analysis(JobId=self.jobId)
-            else:
-                response = self.textract.get_document_analysis(JobId=self.jobId, NextToken=paginationToken)
-
-            blocks = response['Blocks']
-            table_csv = self.get_table_csv_results(blocks)
-            # replace content
-            with open(self.output_csv_path, "at") as fout:
-                fout.write(table_csv)
+        table_csv = self.get_table_csv_results(store)
+        # replace content
+        with open(self.output_csv_path, "at") as fout:
+            fout.write(table_csv)
 
-            if 'NextToken' in response:
-                paginationToken = response['NextToken']
-            else:
-                finished = True
         return tables
 
     def GetTextLines(self):
@@ -181,20 +226,9 @@ class Textract:
         Return list of text lines detected from Textract
         :return: none
         """
-        self.WaitForJob()
-
         lines = []
-        paginationToken = None
-        finished = False
-
-        while finished == False:
 
-            response = None
-
-            if paginationToken == None:
-                response = self.textract.get_document_text_detection(JobId=self.jobId)
-            else:
-                response = self.textract.get_document_text_detection(JobId=self.jobId, NextToken=paginationToken)
+        for response in self.responses:
 
             blocks = response['Blocks']
 
@@ -202,31 +236,66 @@ class Textract:
                 if block['BlockType'] == 'LINE':
                     lines.append((block['Text'],block['Page'])) #Tuple of detected text line with associated page number
 
-            if 'NextToken' in response:
-                paginationToken = response['NextToken']
-            else:
-                finished = True
+        return lines
 
-            return lines
+    def GetTextPages(self):
+        """
+        Yield the text of every page as soon as all of its lines were read. Textract returns the blocks of a text
+        detection job in page order, so a page is complete once a line of a later page (or the end of the results)
+        is reached
+        :return: generator of tuples (page, text)
+        """
+        current_page = None
+        page_lines = []
+
+        for response in self.responses:
+            for block in response['Blocks']:
+                if block['BlockType'] == 'LINE':
+                    if current_page is not None and block['Page'] != current_page:
+                        yield current_page, ' '.join(page_lines)
+                        page_lines = []
+                    current_page = block['Page']
+                    page_lines.append(block['Text'])
+
+        if current_page is not None:
+            yield current_page, ' '.join(page_lines)
+
+    def ScoreRelevance(self, sentences, model, batch_size=64):
+        """
+        Score sentences with the sentence relevance model. With an inference cache, only sentences missing from the
+        cache are run through the model
+        :param sentences: iterable of sentences
+        :param model: sentence relevance Spacy model
+        :param batch_size: number of sentences scored at once
+        :return: generator of tuples (sentence, relevance score)
+        """
+        if self.inference_cache is None:
+            for doc in model.pipe(sentences, batch_size=batch_size):
+                yield doc.text, doc.cats['relevant']
+            return
+
+        model_id = model_fingerprint('sentence_relevance', model.meta.get('name'), model.meta.get('version'),
+                                     file_signature(model.path)) #Retrained weights invalidate cached scores
+        def compute(batch):
+            return [doc.cats['relevant'] for doc in model.pipe(batch, batch_size=batch_size)]
+
+        sentences = iter(sentences)
+        batch = list(islice(sentences, batch_size))
+        while batch:
+            yield from zip(batch, self.inference_cache.lookup(batch, model_id, compute))
+            batch = list(islice(sentences, batch_size))
 
     #Convert detected Textract lines to sentences in CSV
     def GetSentencesCSV(self):
         """
-        Convert detected Textract lines to sentences in CSV
+        Convert detected Textract lines to sentences in CSV. Pages are streamed through preprocessing, sentence
+        segmentation and the relevance model, and relevant sentences are written as they arrive, so memory use does
+        not grow with the length of the document
         :return: none
         """
+        #Setup textacy preprocessing pipeline. Imported here so table extraction does not load the NLP stack
+        from textacy.preprocessing import pipeline, normalize, remove
 
-        lines = self.GetTextLines() #return list of tuples (text, page)
-        raw_text = []
-
-        last_page = max(lines,key=lambda x: x[1])[1]
-
-        #Merge text lines that are from the same page
-        for page in range(1,last_page+1):
-            page_text = [line[0] for line in filter(lambda x:x[1]==page, lines)]
-            raw_text.append(' '.join(page_text))
-
-        #Setup textacy preprocessing pipeline
         preprocessor = pipeline.make_pipeline(normalize.unicode,
                                               normalize.whitespace,
                                               normalize.bullet_points,
@@ -234,46 +303,73 @@ class Textract:
                                               normalize.quotation_marks,
                                               remove.accents)
 
-        #Sentence segmentation - preprocess raw text and split into sentences
-        nlp = spacy.load('en_core_web_lg', exclude=['ner','lemmatizer'])
-        preprocessed_text = [preprocessor(page) for page in raw_text]
-        docs = nlp.pipe(preprocessed_text)
-
-        sentences = []
-        for doc in docs:
-            for sentence in doc.sents:
-                sentences.append(sentence.text)
+        #Sentence segmentation - preprocess raw text and split into sentences, keeping the page of every sentence
+        preprocessed_pages = ((page, preprocessor(text)) for page, text in self.GetTextPages())
+        sentence_pages = deque()
+        def sentences():
+            for page, sentence in self.segmenter.page_sentences(preprocessed_pages):
+                sentence_pages.append(page)
+                yield sentence
 
         #Use trained sentence relevance model to filter out irrelevant/non-grammatical spans of text
-        sent_relevance_model = spacy.load('./Models/sentence-relevance-model-tok2vec')
-        sent_docs = sent_relevance_model.pipe(sentences)
+        sent_relevance_model = registry.get('sentence_relevance')
+        scored_sentences = self.ScoreRelevance(sentences(), sent_relevance_model)
         with open(self.output_csv_path, 'at', newline='', encoding='utf-8') as fout:
-            fieldnames = ['inputs']
+            fieldnames = ['inputs', 'page']
             writer = csv.DictWriter(fout,fieldnames=fieldnames)
             writer.writeheader()
-            for doc in sent_docs:
-                if doc.cats['relevant'] >= 0.95: #Keep texts with over 95% relevance
+            for sentence, relevance in scored_sentences:
+                page = sentence_pages.popleft() #Scores arrive in the order of the sentences
+                if relevance >= 0.95: #Keep texts with over 95% relevance
                     #Write to CSV
-                    writer.writerow({'inputs':doc.text})
+                    writer.writerow({'inputs':sentence, 'page':page})
 
-    def extract(self, mode, document, output_csv_path):
+    def extract(self, mode, document, output_csv_path, job_id=None, pages=1, cache_key=None, progress=None,
+                responses=None):
         """
         Main function for extraction on a document based on mode
+        :param mode: 'table' or 'text'
+        :param document: S3 key of the document, can be None if cached responses are given
+        :param output_csv_path: path of the output CSV file
+        :param job_id: ID of a job that already finished (e.g. run by the TextractJobManager), skips starting and waiting for a new job
+        :param pages: page count of the document, used to tune how often the job status is polled
+        :param cache_key: key from ResultCache.make_key, cached results are used instead of running a job
+        :param progress: function called with 'nlp' once the job finished, before text results are processed
+        :param responses: cached responses from open_cached, opened before the upload was skipped
         :return: path for output csv file
         """
         self.mode = mode
         self.document = document
         self.output_csv_path = output_csv_path
+        self.pages = pages
+
+        self.paginator = None
+        if responses is None and job_id is None:
+            responses = self.open_cached(cache_key)
+        if responses is not None:
+            self.responses = responses
+        else:
+            if document is None and job_id is None:
+                raise Exception('No document was uploaded and its Textract result is not cached')
+            if job_id is not None:
+                self.jobId = job_id
+            else:
+                if self.mode == 'table':
+                    self.DocumentAnalysis()
+                if self.mode == 'text':
+                    self.DocumentTextDetection()
+                self.WaitForJob()
+
+            self.responses = self.GetResultPages()
+            if self.cache is not None and cache_key is not None:
+                self.responses = self.cache.write(cache_key, self.responses)
 
         if self.mode == 'table':
-            self.DocumentAnalysis()
             self.GetTablesCSV()
 
         if self.mode == 'text':
-            self.DocumentTextDetection()
+            if progress is not None:
+                progress('nlp')
             self.GetSentencesCSV()
 
         return self.output_csv_path
-
-
-
@@ -2,8 +2,13 @@ from PyQt5.QtWidgets import QMainWindow, QApplication, QLabel, QLineEdit, QRadio
 from PyQt5.QtGui import QFont
 from PyQt5.QtCore import Qt
 import sys
+import os
 import PyPDF2
 import subprocess
+import urllib.error
+from daemon_client import submit_job, error_message
+
+DAEMON_URL = os.environ.get('EXTRACTION_DAEMON_URL', 'http://127.0.0.1:8765')
 
 class MainWidget(QMainWindow):
     def __init__(self):
@@ -219,7 +224,7 @@ class MainWidget(QMainWindow):
         if self.job_name.text() == '':
             self.create_message_box('Please input a job name')
         if self.valid_form:
-            command = [r'C:\ProgramData\Anaconda3\envs\TextractPrototype\python.exe', r'C:\Users\Jeffrey.Lu\PycharmProjects\TextractPrototype\main.py']
+            command = []
             if self.text_option.isChecked():
                 command.append('text')
             if self.table_option.isChecked():
@@ -241,7 +246,22 @@ class MainWidget(QMainWindow):
             if self.table_option.isChecked():
                 if self.convert_to_PNG_option.isChecked():
                     command.append('--png')
-            print(subprocess.run(command))
+            self.run_job(command)
+
+    def run_job(self, command):
+        """
+        Submit the job to the extraction daemon, or run main.py in a background process if no daemon is running
+        :param command: main.py command line arguments
+        """
+        try:
+            job = submit_job(DAEMON_URL, command)
+            self.create_message_box(f"Submitted job {job['id']} to the extraction daemon")
+        except urllib.error.HTTPError as error:
+            #The daemon is running but rejected the job, running it locally would fail the same way
+            self.create_message_box(f'The extraction daemon rejected the job: {error_message(error)}')
+        except (urllib.error.URLError, ConnectionError):
+            main_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+            subprocess.Popen([sys.executable, main_path] + command)
 
 if __name__ == '__main__':
     app = QApplication(sys.argv)
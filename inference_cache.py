@@ -0,0 +1,185 @@
+"""
+Persistent cache of model outputs for single sentences, stored in SQLite.
+
+Specification documents repeat a lot of text, so the sentence relevance scores and NER entity groups of every sentence
+are cached across runs and only cache misses are sent to the models. Entries are keyed by the SHA-256 of the
+normalized sentence and the model id/version. The model id includes the size and modification time of the model's
+files, so retraining a model in place invalidates its entries even if its version and config stay the same.
+
+Normalization maps every whitespace character to a plain space. It keeps the length of the sentence unchanged, so the
+character offsets of cached NER entities stay valid for every sentence sharing the key.
+"""
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+WHITESPACE = re.compile(r'\s')
+
+
+def normalize_sentence(sentence):
+    """
+    Normalize a sentence for cache lookups without changing its length
+    :param sentence: sentence text
+    :return: normalized text
+    """
+    return WHITESPACE.sub(' ', sentence)
+
+
+def file_signature(path):
+    """
+    Return the size and modification time of a model file, or of every file in a model directory
+    :param path: model file or directory, None if the model was not loaded from disk
+    :return: string listing relative path, size and modification time of every file
+    """
+    if path is None or not os.path.exists(path):
+        return ''
+    path = str(path)
+    if os.path.isfile(path):
+        files = [path]
+    else:
+        files = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+    signature = []
+    for file in files:
+        stat = os.stat(file)
+        signature.append(f'{os.path.relpath(file, path)}:{stat.st_size}:{stat.st_mtime_ns}')
+    return '|'.join(signature)
+
+
+def model_fingerprint(name, *parts):
+    """
+    Return a model id that changes whenever the model changes
+    :param name: model name
+    :param parts: strings identifying the model version, e.g. the spaCy meta version or the Transformer config, and
+                  the file_signature of its weights
+    :return: model id
+    """
+    digest = hashlib.sha256('\0'.join(str(part) for part in parts).encode('utf-8')).hexdigest()[:16]
+    return f'{name}:{digest}'
+
+
+class InferenceCache:
+
+    def __init__(self, path='.inference_cache.sqlite', max_entries=1000000):
+        """
+        :param path: path of the SQLite database
+        :param max_entries: number of entries above which the least recently used entries are evicted
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS predictions '
+                                '(key TEXT PRIMARY KEY, model TEXT, value TEXT, last_used REAL)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used)')
+        self.connection.commit()
+        self.count = self.connection.execute('SELECT COUNT(*) FROM predictions').fetchone()[0]
+
+    @staticmethod
+    def make_key(sentence, model_id):
+        return hashlib.sha256(f'{model_id}\0{normalize_sentence(sentence)}'.encode('utf-8')).hexdigest()
+
+    def lookup(self, sentences, model_id, compute):
+        """
+        Return the model output of every sentence, computing only the cache misses
+        :param sentences: list of sentences
+        :param model_id: model id from model_fingerprint
+        :param compute: function taking the list of missed sentences and returning their outputs (JSON serializable)
+        :return: list of outputs in the order of the sentences
+        """
+        keys = [self.make_key(sentence, model_id) for sentence in sentences]
+        cached = self.get_many(keys)
+
+        missed = [i for i, key in enumerate(keys) if key not in cached]
+        with self.lock:
+            self.hits += len(sentences) - len(missed)
+            self.misses += len(missed)
+
+        computed = compute([sentences[i] for i in missed]) if missed else []
+        self.put_many([(keys[i], value) for i, value in zip(missed, computed)], model_id)
+
+        results = [cached.get(key) for key in keys]
+        for i, value in zip(missed, computed):
+            results[i] = value
+        return results
+
+    def get_many(self, keys):
+        """
+        Return the cached values of the keys that are in the cache and mark them as recently used
+        :param keys: list of cache keys
+        :return: dict of key -> value
+        """
+        values = {}
+        with self.lock:
+            for start in range(0, len(keys), 500): #Stay below SQLite's limit of host parameters
+                chunk = list(set(keys[start:start + 500]))
+                placeholders = ','.join('?' * len(chunk))
+                rows = self.connection.execute(f'SELECT key, value FROM predictions WHERE key IN ({placeholders})',
+                                               chunk).fetchall()
+                values.update((key, json.loads(value)) for key, value in rows)
+                if rows:
+                    self.connection.execute(f'UPDATE predictions SET last_used = ? WHERE key IN ({placeholders})',
+                                            [time.time()] + chunk)
+            self.connection.commit()
+        return values
+
+    def put_many(self, items, model_id):
+        """
+        Store computed values and evict the least recently used entries if the cache is full
+        :param items: list of (key, value)
+        :param model_id: model id of the values
+        :return: none
+        """
+        if not items:
+            return
+        now = time.time()
+        with self.lock:
+            self.connection.executemany('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?)',
+                                        [(key, model_id, json.dumps(value), now) for key, value in items])
+            self.connection.commit()
+            self.count += len(items) #Upper bound, replaced entries are counted again
+        if self.count > self.max_entries:
+            self.evict()
+
+    def evict(self):
+        """
+        Delete the least recently used entries above max_entries
+        :return: none
+        """
+        with self.lock:
+            count = self.connection.execute('SELECT COUNT(*) FROM predictions').fetchone()[0]
+            if count > self.max_entries:
+                self.connection.execute('DELETE FROM predictions WHERE key IN '
+                                        '(SELECT key FROM predictions ORDER BY last_used LIMIT ?)',
+                                        [count - self.max_entries])
+                self.connection.commit()
+                count = self.max_entries
+            self.count = count
+
+    def add_counts(self, hits, misses):
+        """
+        Add the hits and misses of lookups made through another connection to the same cache, e.g. in a worker process
+        :param hits: number of hits
+        :param misses: number of misses
+        :return: none
+        """
+        with self.lock:
+            self.hits += hits
+            self.misses += misses
+
+    def stats(self):
+        """
+        Return the hit rate of the lookups made through this cache
+        :return: dict of hits, misses and hit rate
+        """
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / total if total else 0.0}
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,311 @@
+"""
+Run many Amazon Textract jobs concurrently from a single asyncio event loop.
+
+Job workflow:
+    1. Submit start_document_analysis / start_document_text_detection for every document, throttled to the
+       account's Start* TPS limit and capped by the number of jobs allowed in flight
+    2. Wait for every job from the same event loop. With a completion queue, jobs are started with a NotificationChannel
+       and their completion messages are dispatched from the queue. Without one (or when a message does not arrive in
+       time) jobs are polled with an adaptive, jittered backoff. The first poll is scheduled around the expected
+       completion time for the document's page count, later polls back off exponentially
+    3. Return the finished jobs so their results can be parsed with Textract.extract(..., job_id=job.job_id)
+
+boto3 clients are synchronous, so API calls are run in the event loop's default thread pool. run_all can be called
+from several threads at once (e.g. the documents of a batch): all calls run on the manager's own event loop and share
+its in-flight job slots and TPS limiters.
+"""
+import asyncio
+import functools
+import random
+import threading
+import time
+from botocore.exceptions import ClientError
+
+#Error codes returned by Textract when the account's TPS quota is exceeded
+THROTTLING_ERRORS = ['ThrottlingException', 'ProvisionedThroughputExceededException', 'LimitExceededException']
+
+#Job statuses for which the results can be retrieved
+SUCCESS_STATUSES = ['SUCCEEDED', 'PARTIAL_SUCCESS']
+
+
+def poll_delay(attempt, pages=1, base_delay=1.0, seconds_per_page=0.5, backoff=1.5, max_delay=30.0, jitter=0.2):
+    """
+    Seconds to wait before the next status check of a job.
+
+    :param attempt: number of status checks already made for the job
+    :param pages: page count of the document, used to estimate how long the job will take
+    :param base_delay: minimum delay between two status checks
+    :param seconds_per_page: expected Textract processing time per page
+    :param backoff: growth factor of the delay after every unsuccessful status check
+    :param max_delay: upper bound of the delay
+    :param jitter: relative amount of random jitter so that jobs submitted together are not polled together
+    :return: delay in seconds
+    """
+    pages = max(pages or 1, 1)
+    if attempt == 0:
+        delay = base_delay + seconds_per_page * pages #First check around the expected completion time
+    else:
+        delay = max(base_delay, 0.25 * seconds_per_page * pages) * backoff ** (attempt - 1)
+    delay = min(delay, max_delay)
+    return delay * random.uniform(1 - jitter, 1 + jitter)
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter for keeping API calls below a transactions-per-second quota
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        """
+        Wait until a token is available and consume it
+        :return: none
+        """
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class TextractJob:
+    """
+    State of a single Textract job tracked by the TextractJobManager
+    """
+
+    def __init__(self, document, mode, pages=1):
+        self.document = document
+        self.mode = mode
+        self.pages = pages
+        self.job_id = None
+        self.status = 'PENDING'
+        self.status_message = None
+        self.polls = 0
+        self.submitted_at = None
+        self.completed_at = None
+
+    @property
+    def elapsed(self):
+        """
+        Seconds between submission and completion of the job
+        """
+        if self.submitted_at is None or self.completed_at is None:
+            return None
+        return self.completed_at - self.submitted_at
+
+    def __repr__(self):
+        return f'TextractJob(document={self.document!r}, mode={self.mode!r}, job_id={self.job_id!r}, status={self.status!r})'
+
+
+class TextractJobManager:
+
+    def __init__(self, bucket, textract_client, max_concurrent_jobs=10, start_tps=1, get_tps=5,
+                 feature_types=None, poll_options=None, completion_queue=None, notification_timeout=600):
+        """
+        :param bucket: S3 bucket holding the documents
+        :param textract_client: boto3 Textract client
+        :param max_concurrent_jobs: maximum number of jobs in flight at once
+        :param start_tps: transactions per second allowed for Start* calls
+        :param get_tps: transactions per second allowed for Get* calls
+        :param feature_types: feature types for table extraction jobs
+        :param poll_options: keyword arguments passed to poll_delay
+        :param completion_queue: CompletionQueue receiving job completion messages, None to poll job statuses
+        :param notification_timeout: seconds to wait for a completion message before falling back to polling
+        """
+        self.bucket = bucket
+        self.textract = textract_client
+        self.max_concurrent_jobs = max_concurrent_jobs
+        self.start_tps = start_tps
+        self.get_tps = get_tps
+        self.feature_types = feature_types or ['TABLES']
+        self.poll_options = poll_options or {}
+        self.completion_queue = completion_queue
+        self.notification_timeout = notification_timeout
+        self.limits_loop = None #Event loop the limiters were created in
+        self.loop = None
+        self.loop_thread = None
+        self.loop_lock = threading.Lock()
+
+    async def call(self, limiter, method, **kwargs):
+        """
+        Call a Textract API method in the default executor, retrying with backoff when throttled
+        :param limiter: TokenBucket for the API method
+        :param method: name of the Textract client method
+        :return: API response
+        """
+        loop = asyncio.get_running_loop()
+        attempt = 0
+        while True:
+            await limiter.acquire()
+            try:
+                return await loop.run_in_executor(None, functools.partial(getattr(self.textract, method), **kwargs))
+            except ClientError as error:
+                if error.response['Error']['Code'] not in THROTTLING_ERRORS:
+                    raise
+                attempt += 1
+                await asyncio.sleep(poll_delay(attempt, base_delay=0.5, seconds_per_page=0))
+
+    async def submit(self, job):
+        """
+        Start the Textract job for a document
+        :param job: TextractJob to start
+        :return: none
+        """
+        kwargs = {'DocumentLocation': {'S3Object': {'Bucket': self.bucket, 'Name': job.document}}}
+        if self.completion_queue is not None and self.completion_queue.notification_channel is not None:
+            kwargs['NotificationChannel'] = self.completion_queue.notification_channel
+
+        if job.mode == 'table':
+            response = await self.call(self.start_limiter, 'start_document_analysis',
+                                       FeatureTypes=self.feature_types, **kwargs)
+        elif job.mode == 'text':
+            response = await self.call(self.start_limiter, 'start_document_text_detection', **kwargs)
+        else:
+            raise Exception(f'Unknown extraction mode: {job.mode}')
+
+        job.job_id = str(response['JobId'])
+        job.status = 'IN_PROGRESS'
+        if self.completion_queue is not None:
+            self.completion_queue.expect(job.job_id)
+        job.submitted_at = time.monotonic()
+
+    async def dispatch(self):
+        """
+        Receive completion messages and hand them to the jobs waiting on them, until no job is waiting
+        :return: none
+        """
+        loop = asyncio.get_running_loop()
+        while self.waiters:
+            #Messages can also be buffered by other jobs sharing the completion queue
+            for job_id in list(self.waiters):
+                message = self.completion_queue.completed.pop(job_id, None)
+                if message is not None:
+                    future = self.waiters.pop(job_id)
+                    if not future.done():
+                        future.set_result(message)
+            if not self.waiters:
+                break
+            messages = await loop.run_in_executor(None, self.completion_queue.receive, 5)
+            for message in messages:
+                future = self.waiters.pop(message['JobId'], None)
+                if future is not None and not future.done():
+                    future.set_result(message)
+                else:
+                    self.completion_queue.completed[message['JobId']] = message
+
+    async def wait_for_notification(self, job):
+        """
+        Wait for the completion message of a submitted job. The job stays IN_PROGRESS if no message arrives in time
+        :param job: submitted TextractJob
+        :return: none
+        """
+        message = self.completion_queue.completed.pop(job.job_id, None)
+        if message is None:
+            future = asyncio.get_running_loop().create_future()
+            self.waiters[job.job_id] = future
+            if self.dispatcher is None or self.dispatcher.done():
+                self.dispatcher = asyncio.ensure_future(self.dispatch())
+            try:
+                message = await asyncio.wait_for(future, self.notification_timeout)
+            except asyncio.TimeoutError:
+                self.waiters.pop(job.job_id, None)
+                return
+
+        job.status = message['Status']
+        job.status_message = message.get('StatusMessage')
+
+    async def wait(self, job):
+        """
+        Wait until Textract reports a submitted job is no longer in progress
+        :param job: submitted TextractJob
+        :return: none
+        """
+        if self.completion_queue is not None:
+            await self.wait_for_notification(job)
+
+        #Poll the job status if there is no completion queue or the completion message did not arrive
+        method = 'get_document_analysis' if job.mode == 'table' else 'get_document_text_detection'
+        while job.status == 'IN_PROGRESS':
+            await asyncio.sleep(poll_delay(job.polls, job.pages, **self.poll_options))
+            #Only the job status is needed, so ask for the smallest page of results
+            response = await self.call(self.get_limiter, method, JobId=job.job_id, MaxResults=1)
+            job.polls += 1
+            job.status = response['JobStatus']
+            job.status_message = response.get('StatusMessage')
+
+        job.completed_at = time.monotonic()
+        if job.status not in SUCCESS_STATUSES:
+            raise Exception(f'Textract job {job.job_id} for {job.document} failed: {job.status_message}')
+
+    async def run_job(self, job):
+        """
+        Submit a job and wait for it while holding one of the in-flight job slots
+        :param job: TextractJob to run
+        :return: finished TextractJob
+        """
+        async with self.job_slots:
+            await self.submit(job)
+            await self.wait(job)
+        return job
+
+    async def run(self, jobs):
+        """
+        Run all jobs concurrently
+        :param jobs: list of TextractJob
+        :return: list of finished jobs, or the exception raised for each job that failed
+        """
+        #Limiters are bound to the running event loop, so create them here, once per loop so that concurrent runs
+        #share them
+        loop = asyncio.get_running_loop()
+        if self.limits_loop is not loop:
+            self.job_slots = asyncio.Semaphore(self.max_concurrent_jobs)
+            self.start_limiter = TokenBucket(self.start_tps)
+            self.get_limiter = TokenBucket(self.get_tps)
+            self.waiters = {} #Job ID -> future resolved with the job's completion message
+            self.dispatcher = None
+            self.limits_loop = loop
+        return await asyncio.gather(*[self.run_job(job) for job in jobs], return_exceptions=True)
+
+    def event_loop(self):
+        """
+        Return the manager's event loop, starting it on a background thread on first use
+        :return: asyncio event loop
+        """
+        with self.loop_lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.loop_thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+                self.loop_thread.start()
+            return self.loop
+
+    def run_all(self, jobs):
+        """
+        Blocking entry point for running all jobs from synchronous code. Safe to call from several threads at once
+        :param jobs: list of TextractJob
+        :return: list of finished jobs, or the exception raised for each job that failed
+        """
+        return asyncio.run_coroutine_threadsafe(self.run(jobs), self.event_loop()).result()
+
+    def close(self):
+        """
+        Stop the manager's event loop
+        :return: none
+        """
+        with self.loop_lock:
+            if self.loop is not None:
+                self.loop.call_soon_threadsafe(self.loop.stop)
+                self.loop_thread.join()
+                self.loop.close()
+                self.loop = None
+                self.loop_thread = None
+                self.limits_loop = None
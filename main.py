@@ -1,43 +1,193 @@
 from extract import Textract
 from upload import S3Uploader
-from relation_pipeline import RelationsPipeline
+from job_manager import TextractJob, TextractJobManager
+from notifications import shared_sqs_queue
+from cache import ResultCache
+from models import registry, NER_MODELS
+from inference_cache import InferenceCache
+from segmentation import SentenceSegmenter, SEGMENTATION_MODELS
 import boto3
 import argparse
+import importlib
+import os
 import re
 import sys
 
-def main():
+region_name = 'us-east-1'
+bucket = 'textract-bucket-test-1'
+
+class JobCancelled(Exception):
+    pass
+
+def make_completion_queue(args):
+    """
+    Return the completion queue of the configured notification channel
+    :param args: parsed command line arguments
+    :return: process-wide SQSCompletionQueue, None to poll job statuses
+    """
+    #Wait for completion messages instead of polling job statuses if a notification channel is configured
+    if args.sns_topic_arn and args.sns_role_arn and args.sqs_queue_url:
+        #One queue per process, so concurrent jobs of the daemon or a batch do not take each other's messages
+        return shared_sqs_queue(sqs_client=boto3.client('sqs', region_name),
+                                queue_url=args.sqs_queue_url,
+                                sns_topic_arn=args.sns_topic_arn,
+                                role_arn=args.sns_role_arn)
+    return None
+
+def make_job_manager(args, textract, completion_queue):
+    """
+    Create the job manager running the Textract jobs of page images
+    :param args: parsed command line arguments
+    :param textract: boto3 Textract client
+    :param completion_queue: CompletionQueue from make_completion_queue, None to poll job statuses
+    :return: TextractJobManager
+    """
+    return TextractJobManager(bucket=bucket, textract_client=textract, max_concurrent_jobs=args.max_jobs,
+                              completion_queue=completion_queue)
+
+def set_model_memory(args):
+    """
+    Apply --max-model-memory to the model registry. The registry is shared by every job of the process, so this is done
+    once per process (single job or batch) instead of per job. The daemon sets its ceiling when it starts
+    :param args: parsed command line arguments
+    :return: none
+    """
+    if args.max_model_memory is not None:
+        registry.max_memory = args.max_model_memory * 1024 ** 2
+
+def main(args, textract=None, s3=None, progress=None, cancel_event=None, job_manager=None, result_cache=None):
+    """
+    Run one extraction job
+    :param args: parsed command line arguments
+    :param textract: boto3 Textract client, created if not given
+    :param s3: boto3 S3 resource, created if not given
+    :param progress: function called with the name of each stage as the job reaches it
+    :param cancel_event: threading.Event that cancels the job before its next stage when set
+    :param job_manager: TextractJobManager shared with other jobs (e.g. the documents of a batch), so they share its
+                        in-flight job limit and TPS limits. Created for the job if not given
+    :param result_cache: ResultCache shared with other jobs of the process, created for the job if not given
+    :return: none
+    """
+    textract = textract or boto3.client('textract',region_name)
+    s3 = s3 or boto3.resource('s3')
+
+    def report(stage):
+        if cancel_event is not None and cancel_event.is_set():
+            raise JobCancelled(f'Job cancelled before {stage}')
+        if progress is not None:
+            progress(stage)
+
+    #Load the models needed by the job before starting the upload and Textract job
+    if args.warm_up and args.mode == 'text':
+        registry.warm_up([SEGMENTATION_MODELS[args.segmentation], 'sentence_relevance'] +
+                         (['en_core_web_sm', NER_MODELS[args.ner_backend]]
+                          if args.relationships and args.relation_workers <= 1 else [])) #Workers load their own models
 
     if args.start and args.stop:
         page_range = (args.start, args.stop)
     else:
         page_range = None
 
-    uploader = S3Uploader(bucket=bucket, path=args.input, s3_client=s3, page_range=page_range)
-    extractor = Textract(bucket=bucket, textract_client=textract)
+    completion_queue = make_completion_queue(args)
+
+    if args.no_cache:
+        cache = None
+    elif result_cache is not None:
+        cache = result_cache
+    else:
+        cache = ResultCache(directory=args.cache_dir, max_size=args.cache_size * 1024 ** 2)
+
+    #Only text jobs score relevance and tag entities
+    inference_cache = None if args.no_cache or args.mode != 'text' else InferenceCache(path=args.inference_cache)
+
+    uploader = S3Uploader(bucket=bucket, path=args.input, s3_client=s3, page_range=page_range,
+                          content_addressed=args.content_keys)
+    extractor = Textract(bucket=bucket, textract_client=textract, completion_queue=completion_queue, cache=cache,
+                         structured_tables=args.structured_tables, tables_parquet=args.parquet,
+                         inference_cache=inference_cache,
+                         segmenter=SentenceSegmenter(args.segmentation, n_process=args.n_process))
+    pages = uploader.get_page_count()
+    cache_key = cache.make_key(args.input, page_range, args.mode, extractor.feature_types) if cache else None
     output_path = args.output + '/' + args.job_name
 
     if args.mode == 'table':
         if args.png:
+            report('upload')
             s3_keys = uploader.upload(png=True)
-            for key in s3_keys:
-                extractor.extract(mode='table', document=key,
-                                  output_csv_path=output_path + 'Tables.csv')
+            report('textract')
+            #Run the Textract jobs for all page images concurrently
+            manager = job_manager or make_job_manager(args, textract, completion_queue)
+            try:
+                jobs = manager.run_all([TextractJob(document=key, mode='table') for key in s3_keys])
+            finally:
+                if job_manager is None:
+                    manager.close()
+            for index, job in enumerate(jobs):
+                if isinstance(job, Exception):
+                    raise job
+                #Structured tables are written to one file per table, so keep the files of each page image apart
+                tables_path = output_path + (f'Tables_{index}.csv' if args.structured_tables else 'Tables.csv')
+                extractor.extract(mode='table', document=job.document, job_id=job.job_id,
+                                  output_csv_path=tables_path)
         else:
-            s3_key = uploader.upload()
-            extractor.extract(mode='table', document=s3_key,
-                              output_csv_path=output_path + 'Tables.csv')
+            #Skip the upload if the Textract result is cached. The opened entry stays readable if it is evicted
+            report('upload')
+            cached = extractor.open_cached(cache_key)
+            s3_key = None if cached is not None else uploader.upload()
+            report('textract')
+            extractor.extract(mode='table', document=s3_key, pages=pages, cache_key=cache_key,
+                              output_csv_path=output_path + 'Tables.csv', responses=cached)
 
     if args.mode == 'text':
-        s3_key = uploader.upload()
-        text_path = extractor.extract(mode='text',document=s3_key,
-                                      output_csv_path=output_path + 'Text.csv')
+        report('upload')
+        cached = extractor.open_cached(cache_key)
+        s3_key = None if cached is not None else uploader.upload()
+        report('textract')
+        text_path = extractor.extract(mode='text',document=s3_key, pages=pages, cache_key=cache_key,
+                                      output_csv_path=output_path + 'Text.csv', progress=report, responses=cached)
         if args.relationships:
-            pipe = RelationsPipeline()
-            pipe.export_relations(input_data=text_path,
-                                  output_file=output_path + 'Relations.csv')
+            report('relations')
+            #Imported here so jobs without relation extraction do not load transformers/torch
+            from relation_pipeline import RelationsPipeline
+            pipe = RelationsPipeline(inference_cache=inference_cache, backend=args.ner_backend,
+                                     single_pass=not args.two_pass_ner, n_process=args.n_process,
+                                     workers=args.relation_workers)
+            if args.relations_format == 'sqlite':
+                relations_path = args.relation_store
+            else:
+                relations_path = output_path + 'Relations.' + args.relations_format
+            pipe.export_relations(input_data=text_path, output_file=relations_path, output_format=args.relations_format,
+                                  chunk_size=args.chunk_size, document=os.path.abspath(args.input))
+            print(f'Entity alignment: {pipe.alignment_stats}')
+            if args.timings and pipe.ner_engine is not None:
+                print(f'NER inference: {pipe.ner_engine.summary()}')
 
-if __name__ == '__main__':
+    if inference_cache is not None:
+        print(f'Inference cache: {inference_cache.stats()}')
+        inference_cache.close()
+
+    #Per-page fetch and parse timings of the last Textract result read
+    if args.timings and extractor.paginator is not None:
+        print(extractor.paginator.summary())
+
+def import_dependencies(args):
+    """
+    Import the heavy modules the job's code paths import lazily, without running the job. Used to measure the
+    cold-start time of each mode
+    :param args: parsed command line arguments
+    :return: none
+    """
+    modules = ['PyPDF2']
+    if args.png:
+        modules.append('pdf2image')
+    if args.mode == 'text':
+        modules.extend(['spacy', 'textacy.preprocessing'])
+    if args.mode == 'text' and args.relationships:
+        modules.append('relation_pipeline')
+    for module in modules:
+        importlib.import_module(module)
+
+def build_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('mode', choices=['table', 'text'])
     parser.add_argument('input')
@@ -48,20 +198,96 @@ if __name__ == '__main__':
     parser.add_argument('--relationships', action='store_true', dest='relationships', default=False)
     parser.add_argument('--start', dest='start', type=int)
     parser.add_argument('--stop', dest='stop', type=int)
+    parser.add_argument('--max-jobs', dest='max_jobs', type=int, default=10,
+                        help='Textract jobs in flight at once, shared by all documents in batch mode')
+    parser.add_argument('--sns-topic-arn', dest='sns_topic_arn')
+    parser.add_argument('--sns-role-arn', dest='sns_role_arn')
+    parser.add_argument('--sqs-queue-url', dest='sqs_queue_url')
+    parser.add_argument('--cache-dir', dest='cache_dir', default='.textract_cache')
+    parser.add_argument('--cache-size', dest='cache_size', type=int, default=2048, help='Cache size limit in MB')
+    parser.add_argument('--inference-cache', dest='inference_cache', default='.inference_cache.sqlite',
+                        help='SQLite database caching relevance scores and NER predictions per sentence')
+    parser.add_argument('--no-cache', action='store_true', dest='no_cache', default=False,
+                        help='Disable the Textract result cache and the inference cache')
+    parser.add_argument('--structured-tables', action='store_true', dest='structured_tables', default=False,
+                        help='Write one CSV file per table, stitching tables that continue across pages')
+    parser.add_argument('--parquet', action='store_true', dest='parquet', default=False,
+                        help='Also write all table cells into a Parquet file (with --structured-tables)')
+    parser.add_argument('--segmentation', choices=['accurate', 'fast', 'rules'], default='accurate',
+                        help='Sentence segmentation with the parser, the statistical senter or rules')
+    parser.add_argument('--n-process', dest='n_process', type=int, default=1,
+                        help='Processes used for sentence segmentation and relation parsing')
+    parser.add_argument('--ner-backend', dest='ner_backend', choices=['pytorch', 'onnx', 'onnx-int8'], default='pytorch',
+                        help='NER inference with PyTorch, ONNX Runtime, or ONNX Runtime with int8 quantization')
+    parser.add_argument('--relations-format', dest='relations_format', choices=['csv', 'parquet', 'jsonl', 'sqlite'],
+                        default='csv', help='File format of the extracted relations, sqlite adds them to --relation-store')
+    parser.add_argument('--relation-store', dest='relation_store', default='relations.sqlite',
+                        help='SQLite relation store shared by all documents, with --relations-format sqlite')
+    parser.add_argument('--relation-workers', dest='relation_workers', type=int, default=1,
+                        help='Worker processes for relation extraction, each with its own models')
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int,
+                        help='Sentences read and processed at a time during relation extraction')
+    parser.add_argument('--two-pass-ner', action='store_true', dest='two_pass_ner', default=False,
+                        help='Run NER over all sentences before parsing instead of inside the Spacy pipeline')
+    parser.add_argument('--warm-up', action='store_true', dest='warm_up', default=False)
+    parser.add_argument('--max-model-memory', dest='max_model_memory', type=int, help='Memory ceiling for loaded models in MB')
+    parser.add_argument('--timings', action='store_true', dest='timings', default=False)
+    parser.add_argument('--content-keys', action='store_true', dest='content_keys', default=False,
+                        help='Name S3 objects after a hash of their content and skip uploads of existing objects')
+    parser.add_argument('--batch', action='store_true', dest='batch', default=False,
+                        help='Input is a directory of PDFs or a manifest file with one PDF path per line')
+    parser.add_argument('--max-uploads', dest='max_uploads', type=int, default=4,
+                        help='Concurrent uploads in batch mode')
+    parser.add_argument('--max-nlp', dest='max_nlp', type=int, default=1,
+                        help='Documents in sentence processing and relation extraction at once in batch mode')
+    parser.add_argument('--daemon', dest='daemon_url',
+                        help='Submit the job to a running extraction daemon (e.g. http://127.0.0.1:8765) instead of running it here')
+    parser.add_argument('--wait', action='store_true', dest='wait', default=False,
+                        help='With --daemon, wait for the job to finish')
+    return parser
+
+def parse_args(argv=None):
+    """
+    Parse and validate command line arguments
+    :param argv: list of arguments, None for sys.argv
+    :return: parsed arguments
+    """
+    args = build_parser().parse_args(argv)
 
-    args = parser.parse_args()
+    if args.batch:
+        if args.daemon_url:
+            raise Exception('Batch mode cannot be combined with --daemon')
+        if not os.path.exists(args.input):
+            raise Exception('Batch input must be a directory of PDFs or a manifest file')
+        return args
 
     #Check if input is PDF
     pdf_check = re.compile(r'(\.pdf)$')
     if pdf_check.search(args.input) is None:
         raise Exception('Input file must be PDF')
 
-    region_name = 'us-east-1'
-    bucket = 'textract-bucket-test-1'
-    textract = boto3.client('textract',region_name)
-    s3 = boto3.resource('s3')
+    return args
 
-    main()
+if __name__ == '__main__':
+    args = parse_args()
+
+    if args.batch:
+        from batch import run_batch
+        summary = run_batch(args)
+        if summary['failed']:
+            sys.exit(1)
+    elif args.daemon_url:
+        from daemon_client import submit_job, wait_for_job
+        job = submit_job(args.daemon_url, sys.argv[1:])
+        print(f"Submitted job {job['id']}")
+        if args.wait:
+            job = wait_for_job(args.daemon_url, job['id'])
+            print(f"Job {job['id']} {job['status']}")
+            if job['status'] != 'succeeded':
+                sys.exit(1)
+    else:
+        set_model_memory(args)
+        main(args)
 
 
 
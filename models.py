@@ -0,0 +1,212 @@
+"""
+Process-wide registry of the NLP models used for extraction and relation export.
+
+Models are loaded lazily on first use and reused by every Textract.extract and RelationsPipeline.export_relations call
+in the process. An optional memory ceiling unloads the least recently used models when it is exceeded. The memory used
+by a model is estimated from the growth of the process's resident memory while it loads (psutil if installed,
+otherwise the peak resident memory reported by the resource module).
+
+Registered models:
+    - en_core_web_lg: sentence segmentation of extracted text with the dependency parser
+    - en_core_web_lg_senter: fast sentence segmentation with the statistical senter only
+    - sentencizer: rule-based sentence segmentation
+    - sentence_relevance: trained sentence relevance classifier
+    - en_core_web_sm: parser for relation extraction, with the modifier span and transformer_ner components
+    - spaceroberta_CR: Transformer NER model and its tokenizer, as a tuple (model, tokenizer)
+    - spaceroberta_CR_onnx: the NER model exported to ONNX and run with ONNX Runtime, as a tuple (model, tokenizer)
+    - spaceroberta_CR_onnx_int8: the ONNX model with dynamic int8 quantization, as a tuple (model, tokenizer)
+"""
+from collections import OrderedDict, defaultdict
+import threading
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def resident_memory():
+    """
+    Return the resident memory of the process in bytes, 0 if it cannot be measured
+    :return: bytes
+    """
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    if resource is not None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 #Peak resident memory in KB on Linux
+    return 0
+
+
+class ModelRegistry:
+
+    def __init__(self, max_memory=None):
+        """
+        :param max_memory: memory ceiling in bytes for all loaded models, None for no ceiling
+        """
+        self.max_memory = max_memory
+        self.loaders = {}
+        self.models = OrderedDict() #Loaded models in least recently used order
+        self.sizes = {}
+        self.lock = threading.Lock()
+        self.load_locks = defaultdict(threading.Lock)
+
+    def register(self, name, loader):
+        """
+        Register a model loader
+        :param name: model name
+        :param loader: function without arguments returning the loaded model
+        :return: none
+        """
+        self.loaders[name] = loader
+
+    def get(self, name):
+        """
+        Return a model, loading it on first use
+        :param name: registered model name
+        :return: loaded model
+        """
+        with self.lock:
+            if name in self.models:
+                self.models.move_to_end(name)
+                return self.models[name]
+            if name not in self.loaders:
+                raise Exception(f'Unknown model: {name}')
+            load_lock = self.load_locks[name]
+
+        #Load outside the registry lock so other models stay available, but only once per model
+        with load_lock:
+            with self.lock:
+                if name in self.models:
+                    self.models.move_to_end(name)
+                    return self.models[name]
+
+            memory_before = resident_memory()
+            model = self.loaders[name]()
+            size = max(resident_memory() - memory_before, 0)
+
+            with self.lock:
+                self.models[name] = model
+                self.sizes[name] = size
+                self.enforce_ceiling(keep=name)
+            return model
+
+    def enforce_ceiling(self, keep=None):
+        """
+        Unload least recently used models until the loaded models fit under the memory ceiling
+        :param keep: name of a model that must stay loaded
+        :return: none
+        """
+        if self.max_memory is None:
+            return
+        for name in list(self.models):
+            if self.memory_usage() <= self.max_memory:
+                break
+            if name != keep:
+                self.unload(name)
+
+    def unload(self, name):
+        """
+        Drop the registry's reference to a model. Memory is freed once no caller holds on to the model
+        :param name: model name
+        :return: none
+        """
+        self.models.pop(name, None)
+        self.sizes.pop(name, None)
+
+    def memory_usage(self):
+        """
+        Return the estimated memory of all loaded models in bytes
+        :return: bytes
+        """
+        return sum(self.sizes.values())
+
+    def loaded(self):
+        """
+        Return the names of the loaded models, least recently used first
+        :return: list of model names
+        """
+        with self.lock:
+            return list(self.models)
+
+    def warm_up(self, names=None):
+        """
+        Load models ahead of their first use
+        :param names: model names to load, None for every registered model
+        :return: none
+        """
+        for name in names if names is not None else list(self.loaders):
+            self.get(name)
+
+
+def load_segmenter():
+    import spacy
+    return spacy.load('en_core_web_lg', exclude=['ner','lemmatizer'])
+
+
+def load_senter():
+    import spacy
+    nlp = spacy.load('en_core_web_lg', exclude=['parser', 'tagger', 'attribute_ruler', 'ner', 'lemmatizer'])
+    nlp.enable_pipe('senter')
+    #Skip the shared tok2vec if the senter does not listen to it
+    if 'tok2vec' in nlp.pipe_names and 'senter' not in nlp.get_pipe('tok2vec').listening_components:
+        nlp.disable_pipe('tok2vec')
+    return nlp
+
+
+def load_sentencizer():
+    import spacy
+    nlp = spacy.blank('en')
+    nlp.add_pipe('sentencizer')
+    return nlp
+
+
+def load_sentence_relevance():
+    import spacy
+    return spacy.load('./Models/sentence-relevance-model-tok2vec')
+
+
+def load_relations_parser():
+    import spacy
+    from relation_pipeline import add_relation_components
+    #Components are added while the registry holds the load lock, so concurrent jobs never add them twice
+    return add_relation_components(spacy.load('en_core_web_sm', exclude='ner'))
+
+
+def load_ner_model():
+    from transformers import AutoModelForTokenClassification, AutoTokenizer
+    model = AutoModelForTokenClassification.from_pretrained('./Models/spaceroberta_CR')
+    tokenizer = AutoTokenizer.from_pretrained('./Models/spaceroberta_CR', add_prefix_space=True)
+    return model, tokenizer
+
+
+def load_onnx_ner_model():
+    from onnx_backend import load_onnx_model
+    return load_onnx_model(quantized=False)
+
+
+def load_quantized_ner_model():
+    from onnx_backend import load_onnx_model
+    return load_onnx_model(quantized=True)
+
+
+registry = ModelRegistry()
+registry.register('en_core_web_lg', load_segmenter)
+registry.register('en_core_web_lg_senter', load_senter)
+registry.register('sentencizer', load_sentencizer)
+registry.register('sentence_relevance', load_sentence_relevance)
+registry.register('en_core_web_sm', load_relations_parser)
+registry.register('spaceroberta_CR', load_ner_model)
+registry.register('spaceroberta_CR_onnx', load_onnx_ner_model)
+registry.register('spaceroberta_CR_onnx_int8', load_quantized_ner_model)
+
+#Models needed by each kind of job
+TEXT_MODELS = ['en_core_web_lg', 'sentence_relevance']
+RELATION_MODELS = ['en_core_web_sm', 'spaceroberta_CR']
+
+#NER model of each inference backend
+NER_MODELS = {'pytorch': 'spaceroberta_CR', 'onnx': 'spaceroberta_CR_onnx', 'onnx-int8': 'spaceroberta_CR_onnx_int8'}
@@ -0,0 +1,218 @@
+"""
+Batched inference engine for the spaceroberta_CR token classification model.
+
+Sentences are tokenized once, sorted by token length and packed into batches whose padded size stays under a token
+budget, so short sentences are not padded to the length of long ones. Sentences longer than the model's maximum length
+are split into overlapping windows. Every token is labelled by the window in which it has the most context on both
+sides, and the windows' tokens are merged back into one sentence before grouping entities. Predictions are returned in
+the order of the input sentences.
+
+The output matches the Transformers token-classification pipeline with aggregation_strategy='simple': one list per
+sentence of {'entity_group', 'score', 'word', 'start', 'end'}.
+"""
+import time
+import numpy as np
+
+
+def get_tag(label):
+    """
+    Split a label into its B/I prefix and entity type, like the Transformers pipeline
+    :param label: label name, e.g. 'B-MISSION'
+    :return: (prefix, entity type)
+    """
+    if label.startswith('B-'):
+        return 'B', label[2:]
+    if label.startswith('I-'):
+        return 'I', label[2:]
+    return 'I', label #Labels without a prefix, including 'O', continue the previous group of the same label
+
+
+class NERInferenceEngine:
+
+    def __init__(self, model, tokenizer, token_budget=8192, max_length=512, stride=128, ignore_labels=('O',)):
+        """
+        :param model: Transformer token classification model, PyTorch or ONNX Runtime (optimum ORTModel)
+        :param tokenizer: fast tokenizer of the model
+        :param token_budget: maximum number of tokens in a padded batch
+        :param max_length: maximum number of tokens per sequence, including special tokens
+        :param stride: number of tokens shared by consecutive windows of a long sentence
+        :param ignore_labels: entity groups left out of the predictions
+        """
+        self.model = model
+        self.tokenizer = tokenizer
+        self.token_budget = token_budget
+        self.max_length = min(max_length, tokenizer.model_max_length)
+        self.window_size = self.max_length - tokenizer.num_special_tokens_to_add()
+        if not 0 <= stride < self.window_size:
+            raise Exception(f'Stride must be smaller than the window size of {self.window_size} tokens')
+        self.stride = stride
+        self.ignore_labels = set(ignore_labels)
+        self.labels = model.config.id2label
+        self.sentences = 0
+        self.windows = 0
+        self.batches = 0
+        self.tokens = 0
+        self.padded_tokens = 0
+        self.elapsed = 0.0
+
+    def make_windows(self, length):
+        """
+        Split a sequence of tokens into overlapping windows
+        :param length: number of tokens
+        :return: list of (start, end) token indices
+        """
+        if length <= self.window_size:
+            return [(0, length)]
+        windows = []
+        start = 0
+        while True:
+            end = min(start + self.window_size, length)
+            windows.append((start, end))
+            if end == length:
+                return windows
+            start = end - self.stride
+
+    def make_batches(self, windows):
+        """
+        Pack windows sorted by length into batches whose padded size fits the token budget
+        :param windows: list of (sentence index, start, end, input IDs)
+        :return: list of batches, each a list of windows
+        """
+        batches = []
+        batch = []
+        for window in sorted(windows, key=lambda window: len(window[3])):
+            #Sorted by length, so the last window of a batch is the longest
+            if batch and len(window[3]) * (len(batch) + 1) > self.token_budget:
+                batches.append(batch)
+                batch = []
+            batch.append(window)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def run_batch(self, batch):
+        """
+        Run one batch through the model
+        :param batch: list of windows
+        :return: list of arrays of label probabilities, one per window, without special tokens
+        """
+        import torch
+
+        encoded = self.tokenizer.pad({'input_ids': [window[3] for window in batch]}, return_tensors='pt')
+        special_tokens = [self.tokenizer.get_special_tokens_mask(window[3], already_has_special_tokens=True)
+                          for window in batch]
+        device = self.model.device
+        with torch.inference_mode():
+            logits = self.model(input_ids=encoded['input_ids'].to(device),
+                                attention_mask=encoded['attention_mask'].to(device)).logits
+        probabilities = torch.softmax(logits.float(), dim=-1).cpu().numpy()
+
+        self.batches += 1
+        self.tokens += sum(len(window[3]) for window in batch)
+        self.padded_tokens += probabilities.shape[0] * probabilities.shape[1]
+
+        results = []
+        for i, window in enumerate(batch):
+            mask = np.array(special_tokens[i], dtype=bool)
+            results.append(probabilities[i, :len(window[3])][~mask])
+        return results
+
+    def merge_windows(self, length, windows):
+        """
+        Merge the probabilities of a sentence's windows, taking every token from the window where it is furthest
+        from a window edge
+        :param length: number of tokens in the sentence
+        :param windows: list of ((start, end), probabilities)
+        :return: array of label probabilities of every token
+        """
+        if len(windows) == 1:
+            return windows[0][1]
+        merged = np.zeros((length, len(self.labels)), dtype=np.float32)
+        context = np.full(length, -1)
+        for (start, end), probabilities in windows:
+            positions = np.arange(start, end)
+            window_context = np.minimum(positions - start, end - 1 - positions)
+            better = window_context > context[start:end]
+            merged[start:end][better] = probabilities[better]
+            context[start:end][better] = window_context[better]
+        return merged
+
+    def group_entities(self, input_ids, offsets, probabilities):
+        """
+        Group labelled tokens into entities, like aggregation_strategy='simple'
+        :param input_ids: token IDs of the sentence without special tokens
+        :param offsets: character offsets of the tokens
+        :param probabilities: array of label probabilities of every token
+        :return: list of entity dicts
+        """
+        label_ids = probabilities.argmax(axis=-1)
+        scores = probabilities.max(axis=-1)
+
+        groups = []
+        last_tag = None
+        for i, label_id in enumerate(label_ids):
+            prefix, tag = get_tag(self.labels[int(label_id)])
+            if groups and tag == last_tag and prefix != 'B':
+                groups[-1].append(i)
+            else:
+                groups.append([i])
+            last_tag = tag
+
+        entities = []
+        for group in groups:
+            entity_group = get_tag(self.labels[int(label_ids[group[0]])])[1]
+            if entity_group in self.ignore_labels:
+                continue
+            entities.append({'entity_group': entity_group,
+                             'score': float(np.mean(scores[group])),
+                             'word': self.tokenizer.decode([input_ids[i] for i in group]),
+                             'start': int(offsets[group[0]][0]),
+                             'end': int(offsets[group[-1]][1])})
+        return entities
+
+    def predict(self, sentences):
+        """
+        Predict the entities of every sentence
+        :param sentences: list of sentences
+        :return: list of lists of entity dicts, in the order of the sentences
+        """
+        start_time = time.perf_counter()
+        encoded = self.tokenizer(list(sentences), add_special_tokens=False, return_offsets_mapping=True)
+
+        windows = []
+        for index, input_ids in enumerate(encoded['input_ids']):
+            for start, end in self.make_windows(len(input_ids)):
+                if end > start:
+                    windows.append((index, start, end,
+                                    self.tokenizer.build_inputs_with_special_tokens(input_ids[start:end])))
+
+        sentence_windows = [[] for _ in sentences]
+        for batch in self.make_batches(windows):
+            for window, probabilities in zip(batch, self.run_batch(batch)):
+                sentence_windows[window[0]].append(((window[1], window[2]), probabilities))
+
+        predictions = []
+        for index in range(len(sentences)):
+            input_ids = encoded['input_ids'][index]
+            if not input_ids:
+                predictions.append([])
+                continue
+            probabilities = self.merge_windows(len(input_ids), sorted(sentence_windows[index], key=lambda w: w[0]))
+            predictions.append(self.group_entities(input_ids, encoded['offset_mapping'][index], probabilities))
+
+        self.sentences += len(sentences)
+        self.windows += len(windows)
+        self.elapsed += time.perf_counter() - start_time
+        return predictions
+
+    def summary(self):
+        """
+        Return throughput and padding statistics over all predictions
+        :return: dict of statistics
+        """
+        return {'sentences': self.sentences,
+                'windows': self.windows,
+                'batches': self.batches,
+                'seconds': self.elapsed,
+                'sentences_per_second': self.sentences / self.elapsed if self.elapsed else 0.0,
+                'padding': 1 - self.tokens / self.padded_tokens if self.padded_tokens else 0.0}
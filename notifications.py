@@ -0,0 +1,163 @@
+"""
+Completion queues for learning when Textract jobs finish without polling their status.
+
+Textract publishes a completion message to the SNS topic given as NotificationChannel when a job is started with one.
+The topic is expected to be subscribed by an SQS queue dedicated to this workflow, which the SQSCompletionQueue reads.
+Several processes can read the same SQS queue: a queue only deletes the messages of jobs it expects (jobs started or
+waited on through it) and leaves the others to become visible again for their owner. Within a process, jobs share one
+queue per SQS URL through shared_sqs_queue, so concurrent jobs never take each other's messages.
+LocalCompletionQueue is an in-process stand-in with the same interface, for running without AWS (e.g. in tests).
+
+Completion message shape (body of the SNS message):
+    {"JobId": "...", "Status": "SUCCEEDED" | "FAILED" | "ERROR", "API": "StartDocumentTextDetection", ...}
+"""
+import abc
+import json
+import queue
+import threading
+import time
+
+
+class CompletionQueue(abc.ABC):
+    """
+    Base class of completion queues. Subclasses implement receive()
+    """
+
+    def __init__(self):
+        self.completed = {} #Job ID -> completion message, for messages received before anyone waited on the job
+        self.expected = set() #IDs of the jobs whose completion messages this queue takes
+        self.lock = threading.Lock()
+        self.expected_lock = threading.Lock() #Separate from self.lock, which is held while receiving
+
+    @property
+    def notification_channel(self):
+        """
+        NotificationChannel argument for the Textract Start* calls, None if jobs should not publish notifications
+        """
+        return None
+
+    def expect(self, job_id):
+        """
+        Mark a job as started through this queue, so its completion message is taken when received
+        :param job_id: Textract job ID
+        :return: none
+        """
+        with self.expected_lock:
+            self.expected.add(job_id)
+
+    @abc.abstractmethod
+    def receive(self, wait_time):
+        """
+        Receive the next batch of completion messages
+        :param wait_time: maximum seconds to wait for a message
+        :return: list of completion messages
+        """
+
+    def wait_for(self, job_id, timeout=None):
+        """
+        Block until the completion message of a job is received
+        :param job_id: Textract job ID
+        :param timeout: maximum seconds to wait, None to wait forever
+        :return: completion message, or None if the timeout expired
+        """
+        self.expect(job_id)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.lock:
+                if job_id in self.completed:
+                    return self.completed.pop(job_id)
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                wait_time = 20 if remaining is None else min(remaining, 20)
+                for message in self.receive(wait_time):
+                    self.completed[message['JobId']] = message
+
+
+class SQSCompletionQueue(CompletionQueue):
+
+    def __init__(self, sqs_client, queue_url, sns_topic_arn, role_arn):
+        """
+        :param sqs_client: boto3 SQS client
+        :param queue_url: URL of the SQS queue subscribed to the SNS topic
+        :param sns_topic_arn: ARN of the SNS topic Textract publishes to
+        :param role_arn: ARN of the IAM role that allows Textract to publish to the topic
+        """
+        super().__init__()
+        self.sqs = sqs_client
+        self.queue_url = queue_url
+        self.sns_topic_arn = sns_topic_arn
+        self.role_arn = role_arn
+
+    @property
+    def notification_channel(self):
+        return {'SNSTopicArn': self.sns_topic_arn, 'RoleArn': self.role_arn}
+
+    def receive(self, wait_time):
+        response = self.sqs.receive_message(QueueUrl=self.queue_url,
+                                            MaxNumberOfMessages=10,
+                                            WaitTimeSeconds=int(max(min(wait_time, 20), 0))) #SQS long polling allows at most 20 seconds
+        messages = []
+        for sqs_message in response.get('Messages', []):
+            body = json.loads(sqs_message['Body'])
+            #Unwrap the SNS envelope unless the subscription uses raw message delivery
+            if 'Message' in body and 'JobId' not in body:
+                body = json.loads(body['Message'])
+            #Messages of other readers' jobs are not deleted and become visible again after the visibility timeout
+            with self.expected_lock:
+                if body['JobId'] not in self.expected:
+                    continue
+                self.expected.discard(body['JobId'])
+            messages.append(body)
+            self.sqs.delete_message(QueueUrl=self.queue_url, ReceiptHandle=sqs_message['ReceiptHandle'])
+        return messages
+
+
+_shared_queues = {}
+_shared_queues_lock = threading.Lock()
+
+
+def shared_sqs_queue(sqs_client, queue_url, sns_topic_arn, role_arn):
+    """
+    Return the process-wide SQSCompletionQueue of an SQS queue, creating it on first use. Jobs running concurrently in
+    one process (daemon jobs, batch documents) share its buffer of received messages
+    :param sqs_client: boto3 SQS client, used if the queue is created
+    :param queue_url: URL of the SQS queue subscribed to the SNS topic
+    :param sns_topic_arn: ARN of the SNS topic Textract publishes to
+    :param role_arn: ARN of the IAM role that allows Textract to publish to the topic
+    :return: SQSCompletionQueue
+    """
+    key = (queue_url, sns_topic_arn, role_arn)
+    with _shared_queues_lock:
+        if key not in _shared_queues:
+            _shared_queues[key] = SQSCompletionQueue(sqs_client, queue_url, sns_topic_arn, role_arn)
+        return _shared_queues[key]
+
+
+class LocalCompletionQueue(CompletionQueue):
+    """
+    In-process completion queue. Completion messages are published by calling publish()
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.messages = queue.Queue()
+
+    def publish(self, job_id, status='SUCCEEDED', api=None):
+        """
+        Publish the completion message of a job
+        :param job_id: Textract job ID
+        :param status: completion status of the job
+        :param api: name of the Textract API that started the job
+        :return: none
+        """
+        self.messages.put({'JobId': job_id, 'Status': status, 'API': api})
+
+    def receive(self, wait_time):
+        try:
+            messages = [self.messages.get(timeout=max(wait_time, 0.001))]
+        except queue.Empty:
+            return []
+        while not self.messages.empty():
+            messages.append(self.messages.get_nowait())
+        return messages
@@ -0,0 +1,130 @@
+"""
+ONNX Runtime CPU backend for the spaceroberta_CR NER model.
+
+The PyTorch model is exported to ONNX with optimum, optionally with dynamic int8 quantization of its weights, and run
+with ONNX Runtime's CPU execution provider. The exported model plugs into NERInferenceEngine like the PyTorch model, so
+predictions keep the aggregation_strategy='simple' output format.
+
+Usage:
+    python onnx_backend.py export [--no-quantize]
+        Export ./Models/spaceroberta_CR to ./Models/spaceroberta_CR-onnx (model.onnx and model_quantized.onnx)
+
+    python onnx_backend.py parity SENTENCES_CSV [--backend onnx-int8] [--min-agreement 0.98]
+        Compare the predictions of an ONNX backend with the PyTorch backend on the 'inputs' column of a Text.csv file.
+        Fails (exit code 1) if fewer sentences than --min-agreement get identical entities
+"""
+import argparse
+import os
+import sys
+
+MODEL_DIR = './Models/spaceroberta_CR'
+ONNX_DIR = './Models/spaceroberta_CR-onnx'
+QUANTIZED_FILE = 'model_quantized.onnx'
+
+
+def export_onnx(model_dir=MODEL_DIR, output_dir=ONNX_DIR, quantize=True, quantization='avx2'):
+    """
+    Export the token classification model to ONNX
+    :param model_dir: directory of the PyTorch model
+    :param output_dir: directory of the exported model
+    :param quantize: also write a model with dynamic int8 quantization of its weights
+    :param quantization: instruction set targeted by the quantized model: 'avx2', 'avx512', 'avx512_vnni' or 'arm64'
+    :return: output directory
+    """
+    from optimum.onnxruntime import ORTModelForTokenClassification, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    from transformers import AutoTokenizer
+
+    model = ORTModelForTokenClassification.from_pretrained(model_dir, export=True)
+    model.save_pretrained(output_dir)
+    AutoTokenizer.from_pretrained(model_dir, add_prefix_space=True).save_pretrained(output_dir)
+
+    if quantize:
+        quantization_config = getattr(AutoQuantizationConfig, quantization)(is_static=False, per_channel=False)
+        quantizer = ORTQuantizer.from_pretrained(model)
+        quantizer.quantize(save_dir=output_dir, quantization_config=quantization_config)
+    return output_dir
+
+
+def load_onnx_model(quantized=True, onnx_dir=ONNX_DIR):
+    """
+    Load the exported model on ONNX Runtime's CPU execution provider, exporting it first if needed
+    :param quantized: load the int8 quantized model
+    :param onnx_dir: directory of the exported model
+    :return: (model, tokenizer)
+    """
+    from optimum.onnxruntime import ORTModelForTokenClassification
+    from transformers import AutoTokenizer
+
+    file_name = QUANTIZED_FILE if quantized else 'model.onnx'
+    if not os.path.exists(os.path.join(onnx_dir, file_name)):
+        export_onnx(output_dir=onnx_dir, quantize=quantized)
+
+    model = ORTModelForTokenClassification.from_pretrained(onnx_dir, file_name=file_name,
+                                                           provider='CPUExecutionProvider')
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_DIR, add_prefix_space=True)
+    return model, tokenizer
+
+
+def check_parity(sentences, backend='onnx-int8', token_budget=8192):
+    """
+    Compare the entities predicted by a backend with the PyTorch backend
+    :param sentences: list of sentences
+    :param backend: NER backend name from models.NER_MODELS
+    :param token_budget: maximum number of tokens in a padded batch
+    :return: dict of agreement statistics and the throughput of both backends
+    """
+    from models import registry, NER_MODELS
+    from ner_inference import NERInferenceEngine
+
+    engines = {}
+    predictions = {}
+    for name in ['pytorch', backend]:
+        model, tokenizer = registry.get(NER_MODELS[name])
+        engines[name] = NERInferenceEngine(model, tokenizer, token_budget=token_budget)
+        predictions[name] = engines[name].predict(sentences)
+
+    def entity_set(prediction):
+        return {(entity['entity_group'], entity['start'], entity['end']) for entity in prediction}
+
+    identical = 0
+    matched = expected_count = predicted_count = 0
+    for expected, predicted in zip(predictions['pytorch'], predictions[backend]):
+        expected, predicted = entity_set(expected), entity_set(predicted)
+        identical += expected == predicted
+        matched += len(expected & predicted)
+        expected_count += len(expected)
+        predicted_count += len(predicted)
+
+    precision = matched / predicted_count if predicted_count else 1.0
+    recall = matched / expected_count if expected_count else 1.0
+    return {'sentences': len(sentences),
+            'agreement': identical / len(sentences) if sentences else 1.0,
+            'entity_f1': 2 * precision * recall / (precision + recall) if precision + recall else 0.0,
+            'pytorch_sentences_per_second': engines['pytorch'].summary()['sentences_per_second'],
+            'backend_sentences_per_second': engines[backend].summary()['sentences_per_second']}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = subparsers.add_parser('export')
+    export_parser.add_argument('--no-quantize', action='store_false', dest='quantize', default=True)
+    export_parser.add_argument('--quantization', choices=['avx2', 'avx512', 'avx512_vnni', 'arm64'], default='avx2')
+
+    parity_parser = subparsers.add_parser('parity')
+    parity_parser.add_argument('sentences')
+    parity_parser.add_argument('--backend', choices=['onnx', 'onnx-int8'], default='onnx-int8')
+    parity_parser.add_argument('--min-agreement', dest='min_agreement', type=float, default=0.98)
+
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        print(export_onnx(quantize=args.quantize, quantization=args.quantization))
+    if args.command == 'parity':
+        import pandas as pd
+        sentences = [str(sentence) for sentence in pd.read_csv(args.sentences)['inputs'].values]
+        result = check_parity(sentences, backend=args.backend)
+        print(result)
+        sys.exit(0 if result['agreement'] >= args.min_agreement else 1)
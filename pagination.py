@@ -0,0 +1,106 @@
+"""
+Prefetching paginator for the results of a Textract job.
+
+The next page of results is requested on a background thread while the caller parses the current page, so network
+round-trips and parsing overlap. At most `prefetch` fetched pages wait in a bounded queue. Per-page timings are
+recorded to show which side is the bottleneck:
+    - fetch_times: seconds spent in each Get* call
+    - parse_times: seconds the caller spent on each page before asking for the next one
+    - wait_times: seconds the caller waited for each page to arrive
+"""
+import queue
+import threading
+import time
+
+_DONE = object()
+
+
+class PrefetchPaginator:
+
+    def __init__(self, get_results, job_id, max_results=1000, prefetch=2):
+        """
+        :param get_results: Textract client method, get_document_analysis or get_document_text_detection
+        :param job_id: Textract job ID
+        :param max_results: blocks requested per page of results
+        :param prefetch: maximum number of fetched pages waiting to be parsed
+        """
+        self.get_results = get_results
+        self.job_id = job_id
+        self.max_results = max_results
+        self.prefetch = prefetch
+        self.fetch_times = []
+        self.parse_times = []
+        self.wait_times = []
+
+    def fetch_pages(self, pages, stop):
+        """
+        Fetch every page of results into the queue, following the pagination tokens
+        :param pages: bounded queue shared with the caller
+        :param stop: event set when the caller stops reading
+        :return: none
+        """
+        paginationToken = None
+        try:
+            while not stop.is_set():
+                kwargs = {'JobId': self.job_id, 'MaxResults': self.max_results}
+                if paginationToken is not None:
+                    kwargs['NextToken'] = paginationToken
+
+                start = time.perf_counter()
+                response = self.get_results(**kwargs)
+                self.fetch_times.append(time.perf_counter() - start)
+
+                self.put(pages, response, stop)
+                if 'NextToken' not in response:
+                    break
+                paginationToken = response['NextToken']
+        except Exception as error:
+            self.put(pages, error, stop)
+            return
+        self.put(pages, _DONE, stop)
+
+    def put(self, pages, item, stop):
+        #Check regularly whether the caller stopped reading so the thread never blocks forever on a full queue
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def __iter__(self):
+        pages = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        fetcher = threading.Thread(target=self.fetch_pages, args=(pages, stop), daemon=True)
+        fetcher.start()
+
+        try:
+            while True:
+                start = time.perf_counter()
+                item = pages.get()
+                self.wait_times.append(time.perf_counter() - start)
+                if item is _DONE:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+
+                start = time.perf_counter()
+                yield item
+                self.parse_times.append(time.perf_counter() - start)
+        finally:
+            stop.set()
+            fetcher.join()
+
+    def summary(self):
+        """
+        Return total and mean timings over all pages
+        :return: dict of timings in seconds
+        """
+        def stats(times):
+            return {'total': sum(times), 'mean': sum(times) / len(times) if times else 0.0}
+
+        return {'pages': len(self.fetch_times),
+                'fetch': stats(self.fetch_times),
+                'parse': stats(self.parse_times),
+                'wait': stats(self.wait_times),
+                'bottleneck': 'fetch' if sum(self.wait_times) > sum(self.parse_times) else 'parse'}
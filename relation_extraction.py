@@ -1,7 +1,9 @@
 from spacy.tokens import Span, Doc
-from typing import List, Tuple
+from typing import Iterable, Iterator, List, Tuple
 import pandas as pd
 
+RELATION_COLUMNS = ['Sentence', 'Source', 'Source Root', 'Relation', 'Target', 'Target Root', 'Modifier']
+
 def get_subjects_objects(doc: Doc) -> Tuple[List[Doc], List[Doc]]:
     """
     Get subjects that are arguments of the predicate and all objects. Doc argument expected to be a single sentence.
@@ -32,21 +34,52 @@ def get_subjects_objects(doc: Doc) -> Tuple[List[Doc], List[Doc]]:
     return subjects, objects
 
 
-def get_predicate_triples(doc: Doc) -> List[Tuple[Doc, Doc, Doc, Doc]]:
+class DocIndex:
+    """
+    Per-Doc lookups shared by the predicate and relative clause passes: subjects and objects from a single noun chunk walk,
+    object noun chunks by their root token, and the first PP modifier by the token it modifies.
+    """
+
+    def __init__(self, doc: Doc):
+        """
+        :param doc: SpaCy Doc object of a single sentence with 'PP_mods' spans
+        """
+        self.subjects, self.objects = get_subjects_objects(doc)
+        self.object_by_root = {}
+        for obj in self.objects:
+            self.object_by_root.setdefault(obj.root.i, obj) # First object with this root, like list.index
+        self.PP_mod_by_head = {}
+        for mod in doc.spans['PP_mods']:
+            self.PP_mod_by_head.setdefault(mod.root.head.i, mod)
+
+    def object_of(self, token):
+        """
+        :return: object noun chunk rooted at the token, None if the token is not an object root
+        """
+        return self.object_by_root.get(token.i)
+
+    def PP_mod_of(self, token):
+        """
+        :return: first PP modifier of the token, None if it has none
+        """
+        return self.PP_mod_by_head.get(token.i)
+
+
+def get_predicate_triples(doc: Doc, index: DocIndex = None) -> List[Tuple[Doc, Doc, Doc, Doc]]:
     """
     Extract SVO (subject, verb, object) triple from a sentence for verbs in the predicate. Doc argument expected to be a single
     sentence. Only subjects that are named entities are considered.
 
     :param doc: SpaCy Doc object
+    :param index: DocIndex of the doc, built if not given
     :return triples: SVO triples with adverbial prepositional phrase modifier if it exists
     """
+    index = index if index is not None else DocIndex(doc)
     sent_span = doc[0:]
     predicate = [sent_span.root] + list(sent_span.conjuncts)
-    subjects, objects = get_subjects_objects(doc)
 
     # Map verbs in predicate to corresponding objects (direct or prepositional)
     verb_object_mapping = []
-    object_roots = [obj.root for obj in objects]
 
     # Iterate through each verb that makes up the predicate
     for verb in predicate:
@@ -56,30 +89,16 @@ def get_predicate_triples(doc: Doc) -> List[Tuple[Doc, Doc, Doc, Doc]]:
 
             # Direct objects or attributes
             if right_child.dep_ in ['dobj', 'attr']:
-                PP_mod = [mod for mod in doc.spans['PP_mods'] if mod.root.head == right_child]
-                try:
-                    index = object_roots.index(right_child)
-                    if PP_mod:
-                        verb_object_mapping.append((verb.lemma_, objects[index], PP_mod[0]))
-                    else:
-                        verb_object_mapping.append((verb.lemma_, objects[index], None))
-                except:
-                    pass
+                PP_mod = index.PP_mod_of(right_child)
+                obj = index.object_of(right_child)
+                if obj is not None:
+                    verb_object_mapping.append((verb.lemma_, obj, PP_mod))
 
                 # Conjunctions
-                if right_child.conjuncts:
-                    for conj in right_child.conjuncts:
-                        PP_mod_conj = [mod for mod in doc.spans['PP_mods'] if mod.root.head == conj]
-                        try:
-                            index = object_roots.index(conj)
-                            if PP_mod:
-                                verb_object_mapping.append((verb.lemma_, objects[index], PP_mod[0]))
-                            elif PP_mod_conj:
-                                verb_object_mapping.append((verb.lemma_, objects[index], PP_mod_conj[0]))
-                            else:
-                                verb_object_mapping.append((verb.lemma_, objects[index], None))
-                        except:
-                            pass
+                for conj in right_child.conjuncts:
+                    obj = index.object_of(conj)
+                    if obj is not None:
+                        verb_object_mapping.append((verb.lemma_, obj, PP_mod if PP_mod is not None else index.PP_mod_of(conj)))
 
             # Prepositions
             if right_child.dep_ == 'prep':
@@ -91,147 +110,107 @@ def get_predicate_triples(doc: Doc) -> List[Tuple[Doc, Doc, Doc, Doc]]:
 
                     # Find object of the preposition
                     if prep_child.dep_ == 'pobj':
-                        PP_mod = [mod for mod in doc.spans['PP_mods'] if mod.root.head == prep_child]
-                        try:
-                            index = object_roots.index(prep_child)
-                            if PP_mod:
-                                verb_object_mapping.append((prep_verb, objects[index], PP_mod[0]))
-                            else:
-                                verb_object_mapping.append((prep_verb, objects[index], None))
-                        except:
-                            pass
+                        PP_mod = index.PP_mod_of(prep_child)
+                        obj = index.object_of(prep_child)
+                        if obj is not None:
+                            verb_object_mapping.append((prep_verb, obj, PP_mod))
 
                         # Conjunctions
-                        if prep_child.conjuncts:
-                            for conj in prep_child.conjuncts:
-                                PP_mod_conj = [mod for mod in doc.spans['PP_mods'] if mod.root.head == conj]
-                                try:
-                                    index = object_roots.index(conj)
-                                    if PP_mod:
-                                        verb_object_mapping.append((prep_verb, objects[index], PP_mod[0]))
-                                    elif PP_mod_conj:
-                                        verb_object_mapping.append((verb.lemma_, objects[index], PP_mod_conj[0]))
-                                    else:
-                                        verb_object_mapping.append((prep_verb, objects[index], None))
-                                except:
-                                    pass
-
-    triples = [(subj, verb, obj, mod) for subj in subjects
+                        for conj in prep_child.conjuncts:
+                            obj = index.object_of(conj)
+                            if obj is None:
+                                continue
+                            PP_mod_conj = index.PP_mod_of(conj)
+                            if PP_mod is not None:
+                                verb_object_mapping.append((prep_verb, obj, PP_mod))
+                            elif PP_mod_conj is not None:
+                                verb_object_mapping.append((verb.lemma_, obj, PP_mod_conj)) # Relation without the preposition, as before
+                            else:
+                                verb_object_mapping.append((prep_verb, obj, None))
+
+    triples = [(subj, verb, obj, mod) for subj in index.subjects
                for verb, obj, mod in verb_object_mapping]
     return triples
 
 
-def get_relcl_triples(doc: Doc) -> List[Tuple[Doc, Doc, Doc, Doc]]:
+_UNSET = object()
+
+
+def get_relcl_triples(doc: Doc, index: DocIndex = None) -> List[Tuple[Doc, Doc, Doc, Doc]]:
     """
     Extract SVO (subject, verb, object) triples for subjects in a relative clause modifier. Only subjects that
     are named entities are considered.
 
     :param doc: SpaCy Doc object
+    :param index: DocIndex of the doc, built if not given
     :return triples: SVO triples with associated adverbial prepositional phrase modifier if it exists
     """
-    relcl_object_mapping = []
-    _, objects = get_subjects_objects(doc)
-    object_roots = [obj.root for obj in objects]
+    index = index if index is not None else DocIndex(doc)
+    relcl_object_mapping = [] # Accumulates over all relative clauses of the sentence
+    PP_mod = _UNSET # Last PP modifier looked up, also used for conjuncts of right children that are not objects
     triples = []
 
     # Iterate through each token
     for token in doc:
 
-        # Find relative clause modifiers
-        if token.dep_ == 'relcl':
-
-            # Check if it's an object being modified
-            if token.head.dep_ in ['dobj', 'pobj']:
-                try:
-                    index = object_roots.index(token.head)
-                    relcl_subj = objects[index] #assign an object noun chunk as the relative clause subject
-                except:
-                    continue
-
-                # Check if relative clause subject contains entities
-                if relcl_subj.ents:
-                    relcl_conjuncts = [token] + list(token.conjuncts)
-
-                    # Iterate over verbs in the relative clause
-                    for verb in relcl_conjuncts:
-                        # Iterate over right children of the verb
-                        for right_child in verb.rights:
-
-                            # Direct object or attribute
-                            if right_child.dep_ in ['dobj', 'attr']:
-                                PP_mod = [mod for mod in doc.spans['PP_mods'] if mod.root.head == right_child]
-                                try:
-                                    index = object_roots.index(right_child)
-                                    if PP_mod:
-                                        relcl_object_mapping.append((verb.lemma_, objects[index], PP_mod[0]))
-                                    else:
-                                        relcl_object_mapping.append((verb.lemma_, objects[index], None))
-                                except:
-                                    pass
+        # Find relative clause modifiers of an object
+        if token.dep_ != 'relcl' or token.head.dep_ not in ['dobj', 'pobj']:
+            continue
+        relcl_subj = index.object_of(token.head) # assign an object noun chunk as the relative clause subject
+
+        # Check if relative clause subject contains entities
+        if relcl_subj is None or not relcl_subj.ents:
+            continue
+
+        # Iterate over verbs in the relative clause
+        for verb in [token] + list(token.conjuncts):
+            # Iterate over right children of the verb
+            for right_child in verb.rights:
+
+                # Direct object or attribute
+                if right_child.dep_ in ['dobj', 'attr']:
+                    PP_mod = index.PP_mod_of(right_child)
+                    obj = index.object_of(right_child)
+                    if obj is not None:
+                        relcl_object_mapping.append((verb.lemma_, obj, PP_mod))
+
+                # Conjunctions
+                for conj in right_child.conjuncts:
+                    obj = index.object_of(conj)
+                    if obj is None or PP_mod is _UNSET:
+                        continue
+                    relcl_object_mapping.append((verb.lemma_, obj, PP_mod if PP_mod is not None else index.PP_mod_of(conj)))
+
+                # Prepositions
+                if right_child.dep_ == 'prep':
+
+                    prep_verb = ' '.join([verb.lemma_, right_child.text])  # Get prepositional verb
+
+                    # Iterate through all children of the preposition
+                    for prep_child in right_child.children:
+
+                        # Find object of the preposition
+                        if prep_child.dep_ == 'pobj':
+                            PP_mod = index.PP_mod_of(prep_child)
+                            obj = index.object_of(prep_child)
+                            if obj is not None:
+                                relcl_object_mapping.append((prep_verb, obj, PP_mod))
 
                             # Conjunctions
-                            if right_child.conjuncts:
-
-                                for conj in right_child.conjuncts:
-                                    PP_mod_conj = [mod for mod in doc.spans['PP_mods'] if mod.root.head == conj]
-                                    try:
-                                        index = object_roots.index(conj)
-                                        if PP_mod:
-                                            relcl_object_mapping.append((verb.lemma_, objects[index], PP_mod[0]))
-                                        elif PP_mod_conj:
-                                            relcl_object_mapping.append((verb.lemma_, objects[index], PP_mod_conj[0]))
-                                        else:
-                                            relcl_object_mapping.append((verb.lemma_, objects[index], None))
-                                    except:
-                                        pass
-
-                            # Prepositions
-                            if right_child.dep_ == 'prep':
-
-                                prep_verb = ' '.join([verb.lemma_, right_child.text])  # Get prepositional verb
-
-                                # Iterate through all children of the preposition
-                                for prep_child in right_child.children:
-
-                                    # Find object of the preposition
-                                    if prep_child.dep_ == 'pobj':
-                                        PP_mod = [mod for mod in doc.spans['PP_mods'] if mod.root.head == prep_child]
-                                        try:
-                                            index = object_roots.index(prep_child)
-                                            if PP_mod:
-                                                relcl_object_mapping.append((prep_verb, objects[index], PP_mod[0]))
-                                            else:
-                                                relcl_object_mapping.append((prep_verb, objects[index], None))
-                                        except:
-                                            pass
-
-                                        # Conjunctions
-                                        if prep_child.conjuncts:
-
-                                            for conj in prep_child.conjuncts:
-                                                PP_mod_conj = [mod for mod in doc.spans['PP_mods'] if
-                                                               mod.root.head == conj]
-                                                try:
-                                                    index = object_roots.index(conj)
-                                                    if PP_mod:
-                                                        relcl_object_mapping.append(
-                                                            (prep_verb, objects[index], PP_mod[0]))
-                                                    elif PP_mod_conj:
-                                                        relcl_object_mapping.append(
-                                                            (prep_verb, objects[index], PP_mod_conj[0]))
-                                                    else:
-                                                        relcl_object_mapping.append((prep_verb, objects[index], None))
-                                                except:
-                                                    pass
-
-                    triples.extend([(relcl_subj, verb, obj, mod) for verb, obj, mod in relcl_object_mapping])
+                            for conj in prep_child.conjuncts:
+                                obj = index.object_of(conj)
+                                if obj is not None:
+                                    relcl_object_mapping.append((prep_verb, obj, PP_mod if PP_mod is not None else index.PP_mod_of(conj)))
+
+        triples.extend([(relcl_subj, verb, obj, mod) for verb, obj, mod in relcl_object_mapping])
 
     return triples
 
 
 def get_all_triples(doc: Doc) -> List[Tuple[Doc, Doc, Doc, Doc]]:
     """
-    If the sentence root is a VERB or AUX, extract the predicate triples and relative clause triples.
+    If the sentence root is a VERB or AUX, extract the predicate triples and relative clause triples. Both passes share one
+    DocIndex of the sentence.
 
     :param doc: SpaCy Doc object
     :return all_triples: combined list of predicate and relative clause triples
@@ -239,39 +218,44 @@ def get_all_triples(doc: Doc) -> List[Tuple[Doc, Doc, Doc, Doc]]:
     sent_span = doc[0:]
 
     if (sent_span.root.pos_ == 'VERB') or (sent_span.root.pos_ == 'AUX'):
-        pred_triples = get_predicate_triples(doc) # predicate triples
-        relcl_triples = get_relcl_triples(doc) # relative clause triples
+        index = DocIndex(doc)
+        pred_triples = get_predicate_triples(doc, index) # predicate triples
+        relcl_triples = get_relcl_triples(doc, index) # relative clause triples
         all_triples = pred_triples + relcl_triples # combine
 
         return all_triples
 
 
+def iter_relation_rows(docs: Iterable[Doc]) -> Iterator[Tuple]:
+    """
+    Yield the relations of each Doc as it is processed, one row per triple in the order of RELATION_COLUMNS. The modifier is
+    a Span, or None if the relation has none.
+
+    :param docs: iterable of SpaCy Doc objects
+    :return: generator of relation rows
+    """
+    for doc in docs:
+        triples = get_all_triples(doc)
+        if triples:
+            for subj, verb, obj, mod in triples:
+                yield (doc.text,
+                       subj.text,
+                       subj.root.lemma_,
+                       verb,
+                       obj.text,
+                       obj.root.lemma_,
+                       mod)
+
+
 def get_relations(docs: List[Doc]) -> pd.DataFrame:
     """
     Output a dataframe listing extracted relations (verbs) between a source (subject) and a target (object) along with the modifier of the
     relation. 'Source Root' and 'Target Root' columns are the roots of the source and target phrases according to their dependency tree.
     'Modifier' column are the adverbial prepositional phrase modifiers for each relation if it exists.
 
+    Holds every relation in memory, use iter_relation_rows with a relation_writer for large inputs.
+
     :param docs: list of SpaCy Doc objects
     :return relations: dataframe of relations
     """
-    columns = ['Sentence', 'Source', 'Source Root', 'Relation', 'Target', 'Target Root', 'Modifier']
-    relations = pd.DataFrame(columns=columns)
-
-    for doc in docs:
-        triples = get_all_triples(doc)
-        if triples:
-            triples = [(doc.text,
-                        subj.text,
-                        subj.root.lemma_,
-                        verb,
-                        obj.text,
-                        obj.root.lemma_,
-                        mod)
-                       for subj, verb, obj, mod in triples]
-
-        triples = pd.DataFrame(triples, columns=columns)
-        relations = pd.concat([relations, triples])
-
-    relations = relations.reset_index(drop=True)
-    return relations
\ No newline at end of file
+    return pd.DataFrame(list(iter_relation_rows(docs)), columns=RELATION_COLUMNS)
@@ -1,31 +1,234 @@
-from transformers import AutoModelForTokenClassification, AutoTokenizer, pipeline
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
+import numpy as np
 import pandas as pd
-import spacy
 from spacy.tokens import Span
 from spacy.language import Language
-from relation_extraction import get_relations
+from spacy.util import filter_spans, minibatch
+from relation_extraction import iter_relation_rows
+from relation_writer import open_relation_writer, format_row
+from models import registry, NER_MODELS
+from inference_cache import InferenceCache, model_fingerprint, file_signature
+from ner_inference import NERInferenceEngine
 
-class RelationsPipeline:
 
-    def __init__(self, nlp = spacy.load('en_core_web_sm',exclude='ner')):
-        self.nlp = nlp
-        self.initialize_spacy_pipeline()
-        self.initialize_ner_model()
-        self.ner_predictions = None
+CLAUSAL_DEPS = {'relcl', 'advcl', 'acl'}
+
+
+def span_mask(spans, length):
+    """
+    Return a boolean mask over token indices that is True for tokens inside any of the spans
+    :param spans: Spacy spans of one Doc
+    :param length: number of tokens in the Doc
+    :return: NumPy array of booleans
+    """
+    depth = np.zeros(length + 1, dtype=np.int64)
+    for span in spans:
+        depth[span.start] += 1
+        depth[span.end] -= 1
+    return np.cumsum(depth[:length]) > 0
+
+
+def is_projective(doc, left_edges, right_edges):
+    """
+    Check whether every subtree of a parse is the contiguous range between its left and right edge
+    :param doc: parsed Spacy Doc object
+    :param left_edges: array of the left edge index of every token
+    :param right_edges: array of the right edge index of every token
+    :return: bool
+    """
+    heads = [token.head.i for token in doc]
+    #Depth of every token, each token is visited once
+    depths = [-1] * len(doc)
+    for i in range(len(doc)):
+        path = []
+        j = i
+        while depths[j] < 0 and heads[j] != j:
+            path.append(j)
+            j = heads[j]
+        if depths[j] < 0:
+            depths[j] = 0
+        depth = depths[j]
+        for k in reversed(path):
+            depth += 1
+            depths[k] = depth
+    #Subtree sizes, adding the deepest tokens to their heads first
+    sizes = np.ones(len(doc), dtype=np.int64)
+    for i in sorted(range(len(doc)), key=depths.__getitem__, reverse=True):
+        if heads[i] != i:
+            sizes[heads[i]] += sizes[i]
+    return bool(np.all(sizes == right_edges - left_edges + 1))
+
+
+def new_alignment_stats():
+    return {'entities': 0, 'aligned': 0, 'expanded': 0, 'overlapping': 0, 'misaligned': 0}
+
+
+def set_entities(doc, prediction, stats):
+    """
+    Assign the entities predicted for a sentence to its Spacy document. The character indices of the entities are
+    mapped directly to Spacy tokens with doc.char_span. Entities whose boundaries fall inside a token are expanded to
+    whole tokens, entities overlapping a longer entity are dropped, and both are counted in stats.
+
+    :param doc: Spacy Doc object from a single sentence
+    :param prediction: prediction output of a single sentence from the Transformer inference engine
+    :param stats: alignment counters from new_alignment_stats, updated in place
+    :return doc: Spacy Doc object with the assigned entities
+    """
+    spans = []
+    for pred in prediction:
+        stats['entities'] += 1
+        span = doc.char_span(pred['start'], pred['end'], label=pred['entity_group'])
+        if span is None:
+            #Boundaries inside a token, e.g. a subword entity
+            span = doc.char_span(pred['start'], pred['end'], label=pred['entity_group'], alignment_mode='expand')
+            if span is None or len(span) == 0:
+                stats['misaligned'] += 1
+                continue
+            stats['expanded'] += 1
+        spans.append(span)
+
+    entities = filter_spans(spans) #Keep the longest of overlapping entities so doc.ents can be assigned
+    stats['overlapping'] += len(spans) - len(entities)
+    stats['aligned'] += len(entities)
+    doc.ents = entities #Assign spans as entities to Spacy document
+    return doc
+
+
+def ner_model_id(model_name, model):
+    """
+    Return the inference cache model id of a NER model, from its config and the files of its weights
+    :param model_name: registered model name
+    :param model: PyTorch model, or ONNX Runtime model whose model_path is the exported ONNX file
+    :return: model id
+    """
+    weights = getattr(model, 'model_path', None) or getattr(model, 'name_or_path', None)
+    return model_fingerprint(model_name, model.config.to_json_string(), file_signature(weights))
+
+
+class TransformerNER:
+    """
+    Spacy pipeline component running the Transformer NER model batch-wise inside nlp.pipe and setting doc.ents.
+    An inference engine, InferenceCache and alignment counters can be passed per call through component_cfg. Without
+    an engine, the model is looked up in the model registry on every call, so the component never holds on to a model
+    the registry unloaded.
+    """
+
+    def __init__(self, backend='pytorch', token_budget=8192):
+        """
+        :param backend: NER inference backend from models.NER_MODELS
+        :param token_budget: maximum number of tokens in a padded batch of NER inference
+        """
+        if backend not in NER_MODELS:
+            raise Exception(f'Unknown NER backend: {backend}')
+        self.model_name = NER_MODELS[backend]
+        self.token_budget = token_budget
+
+    def __call__(self, doc, inference_cache=None, alignment_stats=None, engine=None, model_id=None):
+        return next(self.pipe([doc], inference_cache=inference_cache, alignment_stats=alignment_stats, engine=engine,
+                              model_id=model_id))
+
+    def pipe(self, docs, batch_size=64, inference_cache=None, alignment_stats=None, engine=None, model_id=None):
+        """
+        :param docs: stream of Spacy Doc objects, one per sentence
+        :param batch_size: number of sentences sent to the inference engine at once
+        :param inference_cache: InferenceCache of NER predictions, None to run every sentence through the model
+        :param alignment_stats: alignment counters from new_alignment_stats, updated in place
+        :param engine: NERInferenceEngine of the caller, None for an engine on the registry's model
+        :param model_id: inference cache model id of the engine's model, from ner_model_id
+        :return: generator of Spacy Doc objects with the assigned entities
+        """
+        if engine is None:
+            model, tokenizer = registry.get(self.model_name)
+            engine = NERInferenceEngine(model, tokenizer, token_budget=self.token_budget)
+        if inference_cache is not None and model_id is None:
+            model_id = ner_model_id(self.model_name, engine.model)
+
+        stats = alignment_stats if alignment_stats is not None else new_alignment_stats()
+        for batch in minibatch(docs, size=batch_size):
+            sentences = [doc.text for doc in batch]
+            if inference_cache is None:
+                predictions = engine.predict(sentences)
+            else:
+                #Only sentences missing from the cache go through the model
+                predictions = inference_cache.lookup(sentences, model_id, engine.predict)
+            for doc, prediction in zip(batch, predictions):
+                yield set_entities(doc, prediction, stats)
+
+
+@Language.factory('transformer_ner', default_config={'backend': 'pytorch', 'token_budget': 8192})
+def create_transformer_ner(nlp, name, backend, token_budget):
+    return TransformerNER(backend=backend, token_budget=token_budget)
+
+
+def add_relation_components(nlp):
+    """
+    Add the modifier span components and one transformer_ner component per NER backend to a Spacy pipeline. The
+    components of the shared en_core_web_sm are added by its registry loader, once and under the registry's load lock
+    :param nlp: Spacy pipeline used for parsing
+    :return: Spacy pipeline
+    """
+    if 'clausal_modifiers' not in nlp.pipe_names:
+        nlp.add_pipe('clausal_modifiers')
+    if 'PP_modifiers' not in nlp.pipe_names:
+        nlp.add_pipe('PP_modifiers')
+    #The components of other backends are disabled when piping
+    for backend in NER_MODELS:
+        if f'transformer_ner_{backend}' not in nlp.pipe_names:
+            nlp.add_pipe('transformer_ner', name=f'transformer_ner_{backend}', config={'backend': backend})
+    return nlp
 
-    def initialize_spacy_pipeline(self):
+
+class RelationsPipeline:
+
+    def __init__(self, nlp=None, inference_cache=None, token_budget=8192, backend='pytorch', single_pass=True,
+                 n_process=1, batch_size=64, workers=1, threads_per_worker=1):
         """
-        Add custom pipeline components for linguistic parsing to the Spacy pipeline
+        :param nlp: Spacy pipeline used for parsing, None for the shared en_core_web_sm from the model registry
+        :param inference_cache: InferenceCache of NER predictions, None to run every sentence through the model
+        :param token_budget: maximum number of tokens in a padded batch of NER inference
+        :param backend: NER inference backend, 'pytorch', 'onnx' (ONNX Runtime) or 'onnx-int8' (ONNX Runtime with
+                        dynamic int8 quantization)
+        :param single_pass: run NER as a component of the Spacy pipeline, in the same batched pass as parsing. Otherwise
+                            all sentences are run through the NER model first and aligned with the parsed documents
+        :param n_process: number of processes used by nlp.pipe. The inference cache is only used with one process, and
+                          alignment counters are only collected with one process
+        :param batch_size: number of sentences per nlp.pipe batch
+        :param workers: number of worker processes for chunked extraction. With more than one worker, each worker loads
+                        its own models and this process loads none
+        :param threads_per_worker: number of PyTorch threads of each worker process
         """
-        self.nlp.add_pipe('clausal_modifiers')
-        self.nlp.add_pipe('PP_modifiers')
+        if backend not in NER_MODELS:
+            raise Exception(f'Unknown NER backend: {backend}')
+        self.inference_cache = inference_cache
+        self.token_budget = token_budget
+        self.backend = backend
+        self.ner_model_name = NER_MODELS[backend]
+        self.ner_pipe_name = f'transformer_ner_{backend}'
+        self.single_pass = single_pass
+        self.n_process = n_process
+        self.batch_size = batch_size
+        self.workers = workers
+        self.threads_per_worker = threads_per_worker
+        self.ner_predictions = None
+        self.alignment_stats = new_alignment_stats()
+        self.ner_engine = None
+        if workers <= 1:
+            #The registry's en_core_web_sm already has the relation components
+            self.nlp = add_relation_components(nlp) if nlp is not None else registry.get('en_core_web_sm')
+            self.initialize_ner_model()
 
     def initialize_ner_model(self):
         """
-        Load Transformer model for NER and its corresponding tokenizer
+        Load Transformer model for NER of the selected backend and its corresponding tokenizer from the model registry,
+        and the batched inference engine running them. The engine is passed to the NER component of the pipeline on
+        every call, so the shared pipeline does not hold on to a model
         """
-        self.model = AutoModelForTokenClassification.from_pretrained('./Models/spaceroberta_CR')
-        self.tokenizer = AutoTokenizer.from_pretrained('./Models/spaceroberta_CR', add_prefix_space=True)
+        self.model, self.tokenizer = registry.get(self.ner_model_name)
+        self.ner_engine = NERInferenceEngine(self.model, self.tokenizer, token_budget=self.token_budget)
+        self.ner_model_id = ner_model_id(self.ner_model_name, self.model)
 
     @Language.component('clausal_modifiers')
     def clausal_modifiers(doc):
@@ -37,10 +240,8 @@ class RelationsPipeline:
         """
         clausal_mods = []
         for token in doc:
-            if token.dep_ in ['relcl', 'advcl', 'acl']: #Dependency tags for relative, adverbial, and adjectival clause modifiers
-              clause_start = token.left_edge.i
-              clause_end = token.right_edge.i + 1
-              clausal_mods.append(Span(doc, clause_start, clause_end))
+            if token.dep_ in CLAUSAL_DEPS: #Dependency tags for relative, adverbial, and adjectival clause modifiers
+              clausal_mods.append(Span(doc, token.left_edge.i, token.right_edge.i + 1))
         doc.spans['clausal_mods'] = clausal_mods
         return doc
 
@@ -51,81 +252,208 @@ class RelationsPipeline:
         Custom pipeline component for assigning Spacy spans for prepositional phrase modifiers that are not part of other clausal modifiers.
         Can be multiple PP modifiers nested in one.
 
+        Tokens inside clausal modifiers are marked in a boolean mask over token indices. For projective parses every subtree is the
+        contiguous range left_edge..right_edge, so each PP modifier runs from the first to the last unmasked token of that range, looked
+        up in precomputed arrays. Non-projective parses fall back to walking each subtree.
+
         :param doc: Spacy Doc object
         :return doc: Spacy Doc object
         """
+        clausal_mask = span_mask(doc.spans['clausal_mods'], len(doc)) #Tokens that are part of a clausal modifier
+        left_edges = np.array([token.left_edge.i for token in doc], dtype=np.int64)
+        right_edges = np.array([token.right_edge.i for token in doc], dtype=np.int64)
+
         PP_mods = []
-        clausal_mod_indices = [tok.i for mod in doc.spans['clausal_mods']
-                             for tok in mod] #Token indices for clausal modifier spans
-        for token in doc:
-            if token.dep_ == 'prep': #Check if token is a preposition
-                PP_indices = [tok.i for tok in list(token.subtree) if tok.i not in clausal_mod_indices] #Retain indices for PP modifier only if they're not part of a clausal modifier
-                if PP_indices:
-                    PP_mods.append(Span(doc, PP_indices[0], PP_indices[-1] + 1)) #Append PP modifier as Span object
+        if is_projective(doc, left_edges, right_edges):
+            positions = np.arange(len(doc))
+            #First unmasked token at or after each index, and last unmasked token at or before it
+            next_free = np.minimum.accumulate(np.where(clausal_mask, len(doc), positions)[::-1])[::-1]
+            previous_free = np.maximum.accumulate(np.where(clausal_mask, -1, positions))
+            for token in doc:
+                if token.dep_ == 'prep': #Check if token is a preposition
+                    first = next_free[left_edges[token.i]]
+                    last = previous_free[right_edges[token.i]]
+                    if first <= last: #Retain PP modifier only if some of it is not part of a clausal modifier
+                        PP_mods.append(Span(doc, int(first), int(last) + 1)) #Append PP modifier as Span object
+        else:
+            for token in doc:
+                if token.dep_ == 'prep':
+                    PP_indices = [tok.i for tok in token.subtree if not clausal_mask[tok.i]]
+                    if PP_indices:
+                        PP_mods.append(Span(doc, PP_indices[0], PP_indices[-1] + 1))
 
         doc.spans['PP_mods'] = PP_mods
         return doc
 
     def get_ner_predictions(self, sentences):
         """
-        Run sentences through Transformer inference pipeline to get entity predictions.
+        Run sentences through the batched Transformer inference engine to get entity predictions.
 
         :param sentences: list of sentences
         :return: none
         """
-
-        inference_pipeline = pipeline(task='token-classification',model=self.model,tokenizer=self.tokenizer, aggregation_strategy='simple')
-        predictions = inference_pipeline(sentences)
+        if self.inference_cache is None:
+            predictions = self.ner_engine.predict(sentences)
+        else:
+            #Only sentences missing from the cache go through the model
+            predictions = self.inference_cache.lookup(sentences, self.ner_model_id, self.ner_engine.predict)
 
         self.ner_predictions = predictions
 
     def align_with_spacy(self, doc, prediction):
         """
         The Transformer inference pipeline specifies the start and stop indices of the predicted entities within the sentence string.
-        We need to align these character indices with token indices obtained using Spacy's tokenizer in order to assign the entities to
-        Spacy documents.
+        These character indices are mapped to Spacy tokens in order to assign the entities to Spacy documents, see set_entities.
 
         :param doc: Spacy Doc object from a single sentence
         :param prediction: prediction output of a single sentence from Transformer inference pipeline
         :return doc: Spacy Doc object with the assigned entities
         """
-        tokenized_predictions = []
-        #Iterate over each predicted entity in the sentence
-        for pred in prediction:
-            entity = pred['word'].strip()
-            tokenized_entity = [word.text for word in self.nlp.tokenizer(entity)] #Tokenize entity using Spacy's tokenizer
-            label = pred['entity_group']
-            start = pred['start'] #Starting character index of entity
-            tokenized_predictions.append((tokenized_entity, label, start))
-
-        spans = []
-        for entity, label, start in tokenized_predictions:
-            for word in doc:
-                #Check if first token of entity and character index lines up
-                if (entity[0] == word.text) and (start == word.idx):
-                    spans.append(Span(doc, word.i, word.i + len(entity), label)) #Append span of tokens pertaining to the entity
-
-        doc.ents = spans #Assign spans as entities to Spacy document
-        return doc
+        return set_entities(doc, prediction, self.alignment_stats)
 
-    def export_relations(self, input_data, output_file):
+    def parse_docs(self, sentences):
         """
-        Extract relationships between entities and export into a CSV file.
+        Parse sentences and tag their entities
 
-        :param input_data: input CSV file of sentences with header 'inputs'
-        :param output_file: output CSV file for the extracted relations
-        :return: none
+        :param sentences: list of sentences
+        :return: generator of Spacy Doc objects with entities and modifier spans
         """
-        df = pd.read_csv(input_data)
-        sentences = list(df['inputs'].values)
+        ner_pipes = [name for name in self.nlp.pipe_names if name.startswith('transformer_ner')]
+        if self.single_pass:
+            #Parsing, entity tagging and modifier spans in one batched pass
+            #SQLite connections and the loaded model stay in this process, other processes use their own registry
+            ner_cfg = {'inference_cache': self.inference_cache if self.n_process == 1 else None,
+                       'engine': self.ner_engine if self.n_process == 1 else None,
+                       'model_id': self.ner_model_id,
+                       'alignment_stats': self.alignment_stats}
+            return self.nlp.pipe(sentences, batch_size=self.batch_size, n_process=self.n_process,
+                                 disable=[name for name in ner_pipes if name != self.ner_pipe_name],
+                                 component_cfg={self.ner_pipe_name: ner_cfg})
 
         self.get_ner_predictions(sentences)
-        docs = self.nlp.pipe(sentences)
-        aligned_docs = [self.align_with_spacy(doc,pred) for doc,pred in zip(docs,self.ner_predictions)]
-        df = get_relations(aligned_docs)
-        df.to_csv(output_file)
+        docs = self.nlp.pipe(sentences, batch_size=self.batch_size, n_process=self.n_process, disable=ner_pipes)
+        return (self.align_with_spacy(doc,pred) for doc,pred in zip(docs,self.ner_predictions))
+
+    @staticmethod
+    def read_sentences(input_data, chunk_size=None):
+        """
+        Read the sentence CSV file
+
+        :param input_data: input CSV file of sentences with header 'inputs', and optionally 'page'
+        :param chunk_size: number of sentences per chunk, None to read all sentences at once
+        :return: generator of tuples (list of sentences, list of (sentence id, page)), the sentence id is the row of
+                 the sentence in the file
+        """
+        chunks = [pd.read_csv(input_data)] if chunk_size is None else pd.read_csv(input_data, chunksize=chunk_size)
+        sentence_id = 0
+        for chunk in chunks:
+            pages = chunk['page'] if 'page' in chunk else [None] * len(chunk)
+            provenance = [(sentence_id + i, int(page) if pd.notna(page) else None) for i, page in enumerate(pages)]
+            sentence_id += len(chunk)
+            yield list(chunk['inputs'].values), provenance
+
+    def worker_config(self):
+        return {'inference_cache': self.inference_cache.path if self.inference_cache is not None else None,
+                'token_budget': self.token_budget,
+                'backend': self.backend,
+                'single_pass': self.single_pass,
+                'batch_size': self.batch_size,
+                'threads': self.threads_per_worker}
+
+    def extract_parallel(self, chunks):
+        """
+        Extract the relations of sentence chunks on a pool of worker processes, each with its own warm models.
+        Workers return formatted relation rows, which are yielded in input order.
+
+        :param chunks: iterable of tuples (list of sentences, list of (sentence id, page))
+        :return: generator of tuples (relation row, (sentence id, page))
+        """
+        #Spawned workers do not inherit the threads and model state of this process
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=context, initializer=init_worker,
+                                 initargs=(self.worker_config(),)) as pool:
+            pending = deque()
+            for sentences, provenance in chunks:
+                pending.append(pool.submit(extract_chunk, sentences, provenance))
+                #Bound the number of chunks in flight so reading does not run ahead of extraction
+                if len(pending) >= 2 * self.workers:
+                    yield from self.collect(pending.popleft().result())
+            while pending:
+                yield from self.collect(pending.popleft().result())
+
+    def collect(self, result):
+        rows, stats, cache_counts = result
+        for name, count in stats.items():
+            self.alignment_stats[name] += count
+        #Lookups of the workers' own cache connections, so the cache stats of this process include them
+        if self.inference_cache is not None:
+            self.inference_cache.add_counts(*cache_counts)
+        return rows
+
+    def export_relations(self, input_data, output_file, output_format=None, batch_size=1000, chunk_size=None,
+                         document=None):
+        """
+        Extract relationships between entities and stream them into an output file as sentences are processed.
+
+        :param input_data: input CSV file of sentences with header 'inputs'
+        :param output_file: output file for the extracted relations, or the relation store database for 'sqlite'
+        :param output_format: 'csv', 'parquet', 'jsonl' or 'sqlite', None to choose from the extension of the output file
+        :param batch_size: number of relations buffered before they are written
+        :param chunk_size: number of sentences read and processed at a time, None to read all sentences at once
+                           (256 with more than one worker)
+        :param document: absolute path of the document, recorded as provenance in the relation store
+        :return: number of relations written
+        """
+        with open_relation_writer(output_file, output_format=output_format, batch_size=batch_size,
+                                  document=document) as writer:
+            if self.workers > 1:
+                for row, provenance in self.extract_parallel(self.read_sentences(input_data, chunk_size or 256)):
+                    writer.write(row, provenance)
+            else:
+                for sentences, provenance in self.read_sentences(input_data, chunk_size):
+                    for doc, source in zip(self.parse_docs(sentences), provenance):
+                        for row in iter_relation_rows([doc]):
+                            writer.write(row, source)
+        return writer.rows
+
 
+#Pipeline of a worker process, created once by init_worker
+_worker_pipeline = None
 
 
+def init_worker(config):
+    """
+    Load the models of a worker process
+    :param config: RelationsPipeline.worker_config of the parent process
+    :return: none
+    """
+    global _worker_pipeline
+    os.environ.setdefault('TOKENIZERS_PARALLELISM', 'false')
+    try:
+        import torch
+        torch.set_num_threads(config['threads']) #Avoid oversubscribing cores shared by all workers
+    except ImportError:
+        pass
+    inference_cache = InferenceCache(path=config['inference_cache']) if config['inference_cache'] is not None else None
+    _worker_pipeline = RelationsPipeline(inference_cache=inference_cache, token_budget=config['token_budget'],
+                                         backend=config['backend'], single_pass=config['single_pass'],
+                                         batch_size=config['batch_size'])
 
 
+def extract_chunk(sentences, provenance):
+    """
+    Extract the relations of a chunk of sentences in a worker process
+    :param sentences: list of sentences
+    :param provenance: list of (sentence id, page) of the sentences
+    :return: (list of (relation row with the modifier as text, (sentence id, page)), alignment counters of the chunk,
+             (inference cache hits, misses) of the chunk)
+    """
+    _worker_pipeline.alignment_stats = new_alignment_stats()
+    inference_cache = _worker_pipeline.inference_cache
+    counts_before = (inference_cache.hits, inference_cache.misses) if inference_cache is not None else (0, 0)
+    rows = [(format_row(row), source)
+            for doc, source in zip(_worker_pipeline.parse_docs(sentences), provenance)
+            for row in iter_relation_rows([doc])]
+    counts_after = (inference_cache.hits, inference_cache.misses) if inference_cache is not None else (0, 0)
+    cache_counts = (counts_after[0] - counts_before[0], counts_after[1] - counts_before[1])
+    return rows, _worker_pipeline.alignment_stats, cache_counts
@@ -0,0 +1,224 @@
+"""
+Embedded relation store in SQLite.
+
+Relations from every document go into one database. Identical triples (source, relation, target and their roots and
+modifier) are stored once and keyed by a hash of their fields. Every occurrence is recorded as a mention with its
+provenance: document, page and sentence id (row of the document's Text.csv). Source and target lemmas and relations are
+indexed case-insensitively, and every relation keeps its number of mentions, so lookups of the most mentioned relations
+stay fast at millions of triples.
+
+Documents are keyed by their absolute path, so documents with the same file name in different directories are kept
+apart. Their file name is stored as display name. Re-exporting a document replaces its mentions. Rows are inserted in one transaction per batch.
+
+Usage:
+    python relation_store.py relations.sqlite related LEMMA [--relation RELATION] [--limit 100]
+    python relation_store.py relations.sqlite stats
+"""
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+#Store column of each relation column after the sentence, see relation_extraction.RELATION_COLUMNS
+STORE_COLUMNS = ['source', 'source_root', 'relation', 'target', 'target_root', 'modifier']
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS relations (key BLOB PRIMARY KEY, source TEXT, source_root TEXT COLLATE NOCASE, '
+    'relation TEXT COLLATE NOCASE, target TEXT, target_root TEXT COLLATE NOCASE, modifier TEXT, '
+    'mention_count INTEGER NOT NULL DEFAULT 0) WITHOUT ROWID',
+    'CREATE TABLE IF NOT EXISTS sentences (document TEXT, sentence_id INTEGER, page INTEGER, text TEXT, '
+    'PRIMARY KEY (document, sentence_id)) WITHOUT ROWID',
+    'CREATE TABLE IF NOT EXISTS mentions (key BLOB, document TEXT, sentence_id INTEGER, '
+    'PRIMARY KEY (key, document, sentence_id)) WITHOUT ROWID',
+    'CREATE TABLE IF NOT EXISTS documents (document TEXT PRIMARY KEY, name TEXT) WITHOUT ROWID',
+]
+
+#Created after stores from before mention_count was added are migrated
+INDEXES = [
+    'CREATE INDEX IF NOT EXISTS relations_source_root ON relations (source_root, relation)',
+    'CREATE INDEX IF NOT EXISTS relations_target_root ON relations (target_root, relation)',
+    'CREATE INDEX IF NOT EXISTS relations_relation ON relations (relation)',
+    'CREATE INDEX IF NOT EXISTS relations_source_count ON relations (source_root, mention_count)',
+    'CREATE INDEX IF NOT EXISTS relations_target_count ON relations (target_root, mention_count)',
+    'CREATE INDEX IF NOT EXISTS mentions_document ON mentions (document)',
+    #Keep mention_count equal to the number of mentions of every relation. Ignored inserts do not fire triggers
+    'CREATE TRIGGER IF NOT EXISTS mentions_insert AFTER INSERT ON mentions BEGIN '
+    'UPDATE relations SET mention_count = mention_count + 1 WHERE key = NEW.key; END',
+    'CREATE TRIGGER IF NOT EXISTS mentions_delete AFTER DELETE ON mentions BEGIN '
+    'UPDATE relations SET mention_count = mention_count - 1 WHERE key = OLD.key; END',
+]
+
+
+def relation_key(fields):
+    """
+    Return the key of a triple
+    :param fields: tuple of STORE_COLUMNS values
+    :return: 16 byte digest
+    """
+    return hashlib.blake2b('\0'.join(fields).encode('utf-8'), digest_size=16).digest()
+
+
+class RelationStore:
+
+    def __init__(self, path='relations.sqlite', cache_size=256):
+        """
+        :param path: path of the SQLite database
+        :param cache_size: SQLite page cache in MB. Keys are random, so bulk inserts touch pages all over the indexes
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(f'PRAGMA cache_size=-{cache_size * 1024}')
+        for statement in SCHEMA:
+            self.connection.execute(statement)
+        columns = [column[1] for column in self.connection.execute('PRAGMA table_info(relations)')]
+        if 'mention_count' not in columns:
+            self.connection.execute('ALTER TABLE relations ADD COLUMN mention_count INTEGER NOT NULL DEFAULT 0')
+            self.connection.execute('UPDATE relations SET mention_count = '
+                                    '(SELECT COUNT(*) FROM mentions WHERE mentions.key = relations.key)')
+        for statement in INDEXES:
+            self.connection.execute(statement)
+        self.connection.commit()
+
+    def add_document(self, document, name=None):
+        """
+        Record the display name of a document
+        :param document: document key, the absolute path of the document
+        :param name: display name, defaults to the file name of the document
+        :return: none
+        """
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO documents VALUES (?, ?)',
+                                    [document, name if name is not None else os.path.basename(document)])
+
+    def delete_document(self, document):
+        """
+        Delete the mentions and sentences of a document, and the relations no other document mentions
+        :param document: document key, the absolute path of the document
+        :return: none
+        """
+        with self.lock, self.connection:
+            self.connection.execute('CREATE TEMP TABLE IF NOT EXISTS deleted_keys (key BLOB PRIMARY KEY)')
+            self.connection.execute('DELETE FROM deleted_keys')
+            self.connection.execute('INSERT OR IGNORE INTO deleted_keys SELECT key FROM mentions WHERE document = ?',
+                                    [document])
+            self.connection.execute('DELETE FROM mentions WHERE document = ?', [document])
+            self.connection.execute('DELETE FROM sentences WHERE document = ?', [document])
+            self.connection.execute('DELETE FROM documents WHERE document = ?', [document])
+            self.connection.execute('DELETE FROM relations WHERE key IN (SELECT key FROM deleted_keys) '
+                                    'AND mention_count <= 0')
+
+    def insert(self, rows, document):
+        """
+        Insert relations in one transaction. Triples already in the store only get a new mention
+        :param rows: list of (relation row, (sentence id, page)), relation rows in the order of
+                     relation_extraction.RELATION_COLUMNS with the modifier as text or None
+        :param document: document key, the absolute path of the document
+        :return: none
+        """
+        relations = []
+        sentences = []
+        mentions = []
+        for row, (sentence_id, page) in rows:
+            fields = tuple('' if value is None else str(value) for value in row[1:])
+            key = relation_key(fields)
+            relations.append((key,) + fields + (0,))
+            sentences.append((document, sentence_id, page, row[0]))
+            mentions.append((key, document, sentence_id))
+
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR IGNORE INTO relations VALUES (?, ?, ?, ?, ?, ?, ?, ?)', relations)
+            self.connection.executemany('INSERT OR REPLACE INTO sentences VALUES (?, ?, ?, ?)', sentences)
+            self.connection.executemany('INSERT OR IGNORE INTO mentions VALUES (?, ?, ?)', mentions)
+
+    def query(self, sql, parameters):
+        with self.lock:
+            cursor = self.connection.execute(sql, parameters)
+            names = [column[0] for column in cursor.description]
+            return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    def related(self, lemma, relation=None, limit=100):
+        """
+        Return the relations whose source or target root is a lemma, most mentioned first
+        :param lemma: source or target root lemma, case-insensitive
+        :param relation: only relations with this verb, None for all
+        :param limit: maximum number of relations
+        :return: list of dicts of the relation columns and its number of mentions
+        """
+        relation_filter = ' AND relation = ?' if relation is not None else ''
+        parameters = [lemma] + ([relation] if relation is not None else []) + [limit]
+        #Top relations of each side straight from the (root, mention_count) indexes, then merged
+        side = (f'SELECT * FROM (SELECT hex(key) AS key, {", ".join(STORE_COLUMNS)}, mention_count AS mentions '
+                f'FROM relations WHERE {{}} = ?{relation_filter} ORDER BY mention_count DESC LIMIT ?)')
+        return self.query(f'{side.format("source_root")} UNION {side.format("target_root")} '
+                          f'ORDER BY mentions DESC LIMIT ?',
+                          parameters + parameters + [limit])
+
+    def find(self, source_root=None, relation=None, target_root=None, limit=100):
+        """
+        Return the relations matching all given fields
+        :param source_root: source root lemma, case-insensitive
+        :param relation: relation verb, case-insensitive
+        :param target_root: target root lemma, case-insensitive
+        :param limit: maximum number of relations
+        :return: list of dicts of the relation columns
+        """
+        conditions = [(name, value) for name, value in
+                      [('source_root', source_root), ('relation', relation), ('target_root', target_root)]
+                      if value is not None]
+        where = ' AND '.join(f'{name} = ?' for name, _ in conditions) or '1'
+        return self.query(f'SELECT hex(key) AS key, {", ".join(STORE_COLUMNS)} FROM relations WHERE {where} LIMIT ?',
+                          [value for _, value in conditions] + [limit])
+
+    def provenance(self, key, limit=100):
+        """
+        Return where a relation was found
+        :param key: relation key as returned by related and find
+        :param limit: maximum number of mentions
+        :return: list of dicts of document, its display name, page, sentence id and sentence text
+        """
+        return self.query('SELECT mentions.document, COALESCE(documents.name, mentions.document) AS name, '
+                          'sentences.page, mentions.sentence_id, sentences.text '
+                          'FROM mentions LEFT JOIN sentences ON sentences.document = mentions.document '
+                          'AND sentences.sentence_id = mentions.sentence_id '
+                          'LEFT JOIN documents ON documents.document = mentions.document '
+                          'WHERE mentions.key = ? LIMIT ?',
+                          [bytes.fromhex(key), limit])
+
+    def stats(self):
+        """
+        Return the number of relations, mentions and documents in the store
+        :return: dict of counts
+        """
+        return self.query('SELECT (SELECT COUNT(*) FROM relations) AS relations, '
+                          '(SELECT COUNT(*) FROM mentions) AS mentions, '
+                          '(SELECT COUNT(DISTINCT document) FROM sentences) AS documents', [])[0]
+
+    def close(self):
+        self.connection.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('store')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    related_parser = subparsers.add_parser('related')
+    related_parser.add_argument('lemma')
+    related_parser.add_argument('--relation')
+    related_parser.add_argument('--limit', type=int, default=100)
+
+    subparsers.add_parser('stats')
+
+    args = parser.parse_args()
+    store = RelationStore(args.store)
+    if args.command == 'related':
+        for relation in store.related(args.lemma, relation=args.relation, limit=args.limit):
+            print(json.dumps(relation))
+    if args.command == 'stats':
+        print(json.dumps(store.stats()))
+    store.close()
@@ -0,0 +1,186 @@
+"""
+Streaming writers for extracted relations.
+
+Relation rows are written in batches as Docs are processed, so memory stays bounded by the batch size instead of the
+number of sentences. Formats:
+    - csv: same layout as DataFrame.to_csv of get_relations, including the unnamed index column
+    - parquet: one row group per batch, requires pyarrow
+    - jsonl: one JSON object per relation
+    - sqlite: relation store shared by all documents, with the provenance of every relation (see relation_store.py)
+"""
+import abc
+import csv
+import json
+import os
+from relation_extraction import RELATION_COLUMNS
+from relation_store import RelationStore
+
+RELATION_FORMATS = {'.csv': 'csv', '.parquet': 'parquet', '.jsonl': 'jsonl', '.sqlite': 'sqlite', '.db': 'sqlite'}
+
+
+def format_row(row):
+    """
+    Convert the modifier span of a relation row to its text
+    :param row: tuple of RELATION_COLUMNS values, the modifier can already be text
+    :return: tuple of strings, the modifier is None if the relation has none
+    """
+    modifier = row[-1]
+    return row[:-1] + (modifier if modifier is None or isinstance(modifier, str) else modifier.text,)
+
+
+class RelationWriter(abc.ABC):
+
+    def __init__(self, path, batch_size=1000, document=None):
+        """
+        :param path: output file
+        :param batch_size: number of relations buffered before they are written
+        :param document: absolute path of the document the relations come from
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.document = document
+        self.batch = []
+        self.rows = 0
+
+    def write(self, row, provenance=None):
+        """
+        Write one relation row
+        :param row: tuple of RELATION_COLUMNS values
+        :param provenance: tuple (sentence id, page) of the sentence the relation was found in
+        :return: none
+        """
+        self.batch.append(self.prepare(row, provenance))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def prepare(self, row, provenance):
+        return format_row(row)
+
+    def write_rows(self, rows):
+        """
+        Write a stream of relation rows
+        :param rows: iterable of tuples of RELATION_COLUMNS values
+        :return: none
+        """
+        for row in rows:
+            self.write(row)
+
+    def flush(self):
+        if self.batch:
+            self.write_batch(self.batch)
+            self.rows += len(self.batch)
+            self.batch = []
+
+    @abc.abstractmethod
+    def write_batch(self, batch):
+        """
+        Write a batch of prepared relation rows
+        :param batch: list of rows returned by prepare
+        :return: none
+        """
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class CSVRelationWriter(RelationWriter):
+
+    def __init__(self, path, batch_size=1000, document=None):
+        super().__init__(path, batch_size, document)
+        self.file = open(path, 'w', newline='', encoding='utf-8')
+        #Same dialect as DataFrame.to_csv
+        self.writer = csv.writer(self.file, quoting=csv.QUOTE_MINIMAL, lineterminator=os.linesep)
+        self.writer.writerow([''] + RELATION_COLUMNS)
+
+    def write_batch(self, batch):
+        self.writer.writerows((self.rows + i,) + row for i, row in enumerate(batch))
+        self.file.flush()
+
+    def close(self):
+        super().close()
+        self.file.close()
+
+
+class JSONLRelationWriter(RelationWriter):
+
+    def __init__(self, path, batch_size=1000, document=None):
+        super().__init__(path, batch_size, document)
+        self.file = open(path, 'w', encoding='utf-8')
+
+    def write_batch(self, batch):
+        self.file.writelines(json.dumps(dict(zip(RELATION_COLUMNS, row))) + '\n' for row in batch)
+        self.file.flush()
+
+    def close(self):
+        super().close()
+        self.file.close()
+
+
+class ParquetRelationWriter(RelationWriter):
+
+    def __init__(self, path, batch_size=1000, document=None):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise Exception('pyarrow is required for Parquet output')
+
+        super().__init__(path, batch_size, document)
+        self.pa = pa
+        self.schema = pa.schema([(name, pa.string()) for name in RELATION_COLUMNS])
+        self.writer = pq.ParquetWriter(path, self.schema)
+
+    def write_batch(self, batch):
+        columns = {name: [row[i] for row in batch] for i, name in enumerate(RELATION_COLUMNS)}
+        self.writer.write_table(self.pa.table(columns, schema=self.schema)) #One row group per batch
+
+    def close(self):
+        super().close()
+        self.writer.close()
+
+
+class StoreRelationWriter(RelationWriter):
+
+    def __init__(self, path, batch_size=1000, document=None):
+        if document is None:
+            raise Exception('A document name is required for the relation store')
+        super().__init__(path, batch_size, document)
+        self.store = RelationStore(path)
+        self.store.delete_document(document) #Replace the relations of an earlier export of the document
+        self.store.add_document(document)
+
+    def prepare(self, row, provenance):
+        return format_row(row), provenance if provenance is not None else (None, None)
+
+    def write_batch(self, batch):
+        self.store.insert(batch, self.document) #One transaction per batch
+
+    def close(self):
+        super().close()
+        self.store.close()
+
+
+WRITERS = {'csv': CSVRelationWriter, 'parquet': ParquetRelationWriter, 'jsonl': JSONLRelationWriter,
+           'sqlite': StoreRelationWriter}
+
+
+def open_relation_writer(path, output_format=None, batch_size=1000, document=None):
+    """
+    Open a streaming relation writer
+    :param path: output file, or the relation store database for 'sqlite'
+    :param output_format: 'csv', 'parquet', 'jsonl' or 'sqlite', None to choose from the file extension
+    :param batch_size: number of relations buffered before they are written
+    :param document: absolute path of the document the relations come from, required for 'sqlite'
+    :return: RelationWriter
+    """
+    if output_format is None:
+        output_format = RELATION_FORMATS.get(os.path.splitext(path)[1].lower(), 'csv')
+    if output_format not in WRITERS:
+        raise Exception(f'Unknown relation format: {output_format}')
+    return WRITERS[output_format](path, batch_size=batch_size, document=document)
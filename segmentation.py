@@ -0,0 +1,70 @@
+"""
+Sentence segmentation of extracted page text.
+
+Modes:
+    - accurate: en_core_web_lg dependency parser (sentence boundaries from the parse)
+    - fast: en_core_web_lg statistical senter only, without tagger and parser
+    - rules: rule-based sentencizer on a blank English pipeline
+
+All modes run through nlp.pipe with a configurable number of processes and batch size.
+"""
+from collections import deque
+from models import registry
+
+SEGMENTATION_MODELS = {'accurate': 'en_core_web_lg', 'fast': 'en_core_web_lg_senter', 'rules': 'sentencizer'}
+
+
+class SentenceSegmenter:
+
+    def __init__(self, mode='accurate', n_process=1, batch_size=8):
+        """
+        :param mode: 'accurate', 'fast' or 'rules'
+        :param n_process: number of processes used by nlp.pipe
+        :param batch_size: number of pages processed per batch
+        """
+        if mode not in SEGMENTATION_MODELS:
+            raise Exception(f'Unknown segmentation mode: {mode}')
+        self.mode = mode
+        self.n_process = n_process
+        self.batch_size = batch_size
+
+    @property
+    def nlp(self):
+        return registry.get(SEGMENTATION_MODELS[self.mode])
+
+    def segment(self, texts):
+        """
+        Split texts into sentences
+        :param texts: iterable of page texts
+        :return: generator of lists of sentences, one list per text
+        """
+        for doc in self.nlp.pipe(texts, n_process=self.n_process, batch_size=self.batch_size):
+            yield [sentence.text for sentence in doc.sents]
+
+    def sentences(self, texts):
+        """
+        Split texts into one stream of sentences
+        :param texts: iterable of page texts
+        :return: generator of sentences
+        """
+        for page_sentences in self.segment(texts):
+            yield from page_sentences
+
+    def page_sentences(self, pages):
+        """
+        Split pages into one stream of sentences, keeping the page number of every sentence
+        :param pages: iterable of tuples (page, text)
+        :return: generator of tuples (page, sentence)
+        """
+        page_numbers = deque()
+
+        def texts():
+            for page, text in pages:
+                page_numbers.append(page)
+                yield text
+
+        #nlp.pipe keeps the order of its inputs, so every segmented text belongs to the oldest pending page
+        for page_sentences in self.segment(texts()):
+            page = page_numbers.popleft()
+            for sentence in page_sentences:
+                yield page, sentence
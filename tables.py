@@ -0,0 +1,186 @@
+"""
+Structured table output from the blocks of a Textract table extraction job.
+
+Table output workflow:
+    1. Fill each TABLE into a preallocated grid from the RowIndex/ColumnIndex/RowSpan/ColumnSpan of its cells
+    2. Stitch tables that continue on the next page when the next page's table repeats the header row
+    3. Write one properly quoted CSV file per table, and optionally one Parquet file of all cells
+       (table id, page, row, col, text, confidence)
+"""
+import csv
+
+CELL_COLUMNS = ['table_id', 'page', 'row', 'col', 'text', 'confidence']
+
+
+def cell_text(cell_id, store):
+    """
+    Return the text of a table cell from its WORD and SELECTION_ELEMENT children
+    :param cell_id: interned id of the CELL block
+    :param store: BlockStore of the job
+    :return: cell text
+    """
+    words = []
+    for child_id in store.child_ids(cell_id):
+        word = store.get(child_id)
+        if word is None:
+            print("Error extracting Table data - block missing from Textract results")
+            continue
+        if word['BlockType'] == 'WORD':
+            words.append(word['Text'] + ' ')
+        if word['BlockType'] == 'SELECTION_ELEMENT':
+            if word['SelectionStatus'] == 'SELECTED':
+                words.append('X ')
+
+    return ''.join(words)
+
+
+class Table:
+    """
+    Table filled into a grid of rows and columns. Each row remembers the page it was found on
+    """
+
+    def __init__(self, table_id, page, n_rows, n_cols):
+        self.table_id = table_id
+        self.page = page
+        self.grid = [[''] * n_cols for _ in range(n_rows)]
+        self.confidence = [[None] * n_cols for _ in range(n_rows)]
+        self.row_pages = [page] * n_rows
+
+    @property
+    def n_cols(self):
+        return len(self.grid[0]) if self.grid else 0
+
+    @property
+    def header(self):
+        return [text.strip() for text in self.grid[0]] if self.grid else []
+
+    def append(self, other, skip_header=True):
+        """
+        Append the rows of a table continuing this one on a later page
+        :param other: continuation Table
+        :param skip_header: drop the continuation's first row (a repeated header)
+        :return: none
+        """
+        start = 1 if skip_header else 0
+        self.grid.extend(other.grid[start:])
+        self.confidence.extend(other.confidence[start:])
+        self.row_pages.extend(other.row_pages[start:])
+
+    def cells(self):
+        """
+        Yield one record per grid position covered by a cell
+        :return: generator of dicts with the CELL_COLUMNS keys
+        """
+        for row_index, (row, confidences, page) in enumerate(zip(self.grid, self.confidence, self.row_pages)):
+            for col_index, (text, confidence) in enumerate(zip(row, confidences)):
+                if confidence is not None:
+                    yield {'table_id': self.table_id, 'page': page, 'row': row_index + 1, 'col': col_index + 1,
+                           'text': text.strip(), 'confidence': confidence}
+
+
+def build_table(table_id, store, table_number):
+    """
+    Fill a TABLE block into a Table grid
+    :param table_id: interned id of the TABLE block
+    :param store: BlockStore of the job
+    :param table_number: id given to the table in the output
+    :return: Table
+    """
+    cells = []
+    for child_id in store.child_ids(table_id):
+        cell = store.get(child_id)
+        if cell is None:
+            print("Error extracting Table data - block missing from Textract results")
+            continue
+        if cell['BlockType'] == 'CELL':
+            cells.append((child_id, cell))
+
+    n_rows = max([cell['RowIndex'] + cell.get('RowSpan', 1) - 1 for _, cell in cells], default=0)
+    n_cols = max([cell['ColumnIndex'] + cell.get('ColumnSpan', 1) - 1 for _, cell in cells], default=0)
+    table = Table(table_number, store.get(table_id)['Page'], n_rows, n_cols)
+
+    for cell_id, cell in cells:
+        text = cell_text(cell_id, store)
+        row, col = cell['RowIndex'] - 1, cell['ColumnIndex'] - 1
+        #Spanned cells repeat their text in every grid position they cover
+        for r in range(row, row + cell.get('RowSpan', 1)):
+            for c in range(col, col + cell.get('ColumnSpan', 1)):
+                table.grid[r][c] = text
+                table.confidence[r][c] = cell.get('Confidence')
+
+    return table
+
+
+def stitch_tables(tables):
+    """
+    Merge tables that continue on the next page. A table continues the previous one if it is on the following page
+    and has the same header row
+    :param tables: list of Table in document order
+    :return: list of stitched Table, renumbered in document order
+    """
+    stitched = []
+    for table in tables:
+        previous = stitched[-1] if stitched else None
+        if (previous is not None and table.page == previous.row_pages[-1] + 1
+                and table.n_cols == previous.n_cols and table.header and table.header == previous.header):
+            previous.append(table)
+        else:
+            stitched.append(table)
+
+    for table_number, table in enumerate(stitched, start=1):
+        table.table_id = table_number
+    return stitched
+
+
+def get_tables(store, stitch=True):
+    """
+    Build every table of a job
+    :param store: BlockStore of the job
+    :param stitch: merge tables continuing across pages
+    :return: list of Table
+    """
+    tables = [build_table(table_id, store, table_number)
+              for table_number, table_id in enumerate(store.of_type('TABLE'), start=1)]
+    return stitch_tables(tables) if stitch else tables
+
+
+def write_tables_csv(tables, output_prefix):
+    """
+    Write every table into its own CSV file
+    :param tables: list of Table
+    :param output_prefix: path prefix of the CSV files, table n is written to <output_prefix>_Table_<n>.csv
+    :return: list of paths of the written files
+    """
+    paths = []
+    for table in tables:
+        path = f'{output_prefix}_Table_{table.table_id}.csv'
+        with open(path, 'w', newline='', encoding='utf-8') as fout:
+            writer = csv.writer(fout, quoting=csv.QUOTE_MINIMAL)
+            writer.writerows([text.strip() for text in row] for row in table.grid)
+        paths.append(path)
+    return paths
+
+
+def write_cells_parquet(tables, path):
+    """
+    Write the cells of all tables into one Parquet file. Requires pyarrow
+    :param tables: list of Table
+    :param path: path of the Parquet file
+    :return: path of the written file
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise Exception('pyarrow is required for Parquet output')
+
+    schema = pa.schema([('table_id', pa.int32()), ('page', pa.int32()), ('row', pa.int32()), ('col', pa.int32()),
+                        ('text', pa.string()), ('confidence', pa.float64())])
+    columns = {name: [] for name in CELL_COLUMNS}
+    for table in tables:
+        for cell in table.cells():
+            for name in CELL_COLUMNS:
+                columns[name].append(cell[name])
+
+    pq.write_table(pa.table(columns, schema=schema), path)
+    return path
@@ -1,52 +1,188 @@
-from PyPDF2 import PdfFileReader, PdfFileWriter
-from pdf2image import convert_from_path
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import tempfile
+import hashlib
+import threading
 import re
 import io
+from cache import sha256_file
+
+#PyPDF2 and pdf2image are imported where they are used, so jobs that do not need them start faster
+
+def render_png_pages(path, first_page, last_page, dpi=200):
+  """
+  Render a window of pages of a PDF file to PNG. Module level so it can run in a process pool
+  :param path: path of the PDF file
+  :param first_page: first page of the window (1-indexed)
+  :param last_page: last page of the window (inclusive)
+  :param dpi: rendering resolution
+  :return: list of each PNG image as bytes
+  """
+  from pdf2image import convert_from_path
+
+  images = convert_from_path(path, dpi=dpi, fmt='png', first_page=first_page, last_page=last_page)
+  png_byte_list = []
+
+  for img in images:
+    img_bytes = io.BytesIO()
+    img.save(img_bytes, format='PNG')
+    png_byte_list.append(img_bytes.getvalue())
+    img.close()
+
+  return png_byte_list
 
 class S3Uploader:
 
-  def __init__(self, bucket, path, s3_client, page_range=None):
+  def __init__(self, bucket, path, s3_client, page_range=None, render_workers=None, upload_workers=8,
+               render_window=2, pages_in_flight=16, in_memory=True, spool_max_size=64 * 1024 ** 2,
+               part_size=16 * 1024 ** 2, max_concurrency=10, content_addressed=False):
+    """
+    :param bucket: S3 bucket to upload to
+    :param path: path of the PDF file
+    :param s3_client: boto3 S3 resource
+    :param page_range: tuple of (start, stop) pages to upload, None for the whole document
+    :param render_workers: number of processes rendering PNG pages, None for one per CPU
+    :param upload_workers: number of threads uploading PNG pages
+    :param render_window: number of pages rendered by one task
+    :param pages_in_flight: maximum number of rendered pages held in memory before they are uploaded
+    :param in_memory: build page subsets in a spooled buffer instead of writing them next to the input file
+    :param spool_max_size: size in bytes above which a page subset buffer spills to a temporary file
+    :param part_size: multipart upload threshold and part size in bytes
+    :param max_concurrency: number of threads uploading the parts of one file
+    :param content_addressed: name S3 objects after a hash of their content and skip objects that already exist
+    """
     self.bucket = bucket
     self.path = path
     self.s3 = s3_client
     self.page_range = page_range
+    self.render_workers = render_workers
+    self.upload_workers = upload_workers
+    self.render_window = render_window
+    self.pages_in_flight = max(pages_in_flight, render_window)
+    self.in_memory = in_memory
+    self.spool_max_size = spool_max_size
+    self.transfer_config = TransferConfig(multipart_threshold=part_size, multipart_chunksize=part_size,
+                                          max_concurrency=max_concurrency, use_threads=True)
+    self.content_addressed = content_addressed
 
-  def subsetPDF(self):
+  def get_subset_writer(self):
     """
-    Create new PDF file with the specified page range
-    :return: none
+    Return a PDF writer holding the pages in the specified page range
+    :return: PdfFileWriter
     """
+    from PyPDF2 import PdfFileReader, PdfFileWriter
+
     pages = [page_num-1 for page_num in list(range(self.page_range[0],self.page_range[1]+1))]
 
     pdf = PdfFileReader(self.path)
-    name = self.path.replace('pdf','')
     writer = PdfFileWriter()
     for page_num in pages:
       writer.addPage(pdf.getPage(page_num))
 
-    subset_pdf_path = f'{name}_Page_{self.page_range[0]}_to_{self.page_range[1]}.pdf'
+    return writer
+
+  def get_subset_path(self):
+    """
+    Return the path of the PDF file with the specified page range
+    :return: path of the subset PDF
+    """
+    name = self.path.replace('pdf','')
+    return f'{name}_Page_{self.page_range[0]}_to_{self.page_range[1]}.pdf'
+
+  def subsetPDF(self):
+    """
+    Create new PDF file with the specified page range
+    :return: none
+    """
+    subset_pdf_path = self.get_subset_path()
     with open(subset_pdf_path,'wb') as f:
-      writer.write(f)
+      self.get_subset_writer().write(f)
 
     return subset_pdf_path
 
-  def get_document_name(self):
+  def subset_to_buffer(self):
     """
-    Return path of the PDF document and its name
-    :return: none
+    Write the specified page range into a buffer that stays in memory unless it grows beyond spool_max_size
+    :return: file object positioned at the start of the subset PDF
     """
+    buffer = tempfile.SpooledTemporaryFile(max_size=self.spool_max_size)
+    self.get_subset_writer().write(buffer)
+    buffer.seek(0)
+    return buffer
 
+  def get_page_count(self):
+    """
+    Return the number of pages that will be uploaded
+    :return: page count
+    """
+    if self.page_range is not None:
+      return self.page_range[1] - self.page_range[0] + 1
+    from PyPDF2 import PdfFileReader
+
+    return PdfFileReader(self.path).getNumPages()
+
+  def get_document_stem(self):
+    """
+    Return the name of the document to upload, without writing any subset PDF
+    :return: doc_name
+    """
     pattern = re.compile(r'[^\\/]+(?=\.pdf$)')  #Regex pattern for matching file name
 
+    if self.page_range == None:
+      return pattern.search(self.path).group()
+    else:
+      return pattern.search(self.get_subset_path()).group()
+
+  def get_document_name(self):
+    """
+    Return path of the PDF document and its name
+    :return: none
+    """
     #Return original path if no page range was given
     if self.page_range == None:
-      doc_name = pattern.search(self.path).group()
-      return self.path, doc_name
+      return self.path, self.get_document_stem()
     #Return path of the subset PDF if page range was given
     else:
       subset_path = self.subsetPDF()
-      doc_name = pattern.search(subset_path).group()
-      return subset_path, doc_name
+      return subset_path, self.get_document_stem()
+
+  def get_content_hash(self):
+    """
+    Return a hash identifying the pages to upload: the SHA-256 of the input PDF, combined with the page range if given
+    :return: hex digest
+    """
+    with open(self.path, 'rb') as f:
+      digest = sha256_file(f)
+    if self.page_range is not None:
+      digest = hashlib.sha256(f'{digest}:{self.page_range[0]}-{self.page_range[1]}'.encode('utf-8')).hexdigest()
+    return digest
+
+  def object_exists(self, s3_key):
+    """
+    Check if an object is already in the bucket with a single metadata call
+    :param s3_key: key of the object
+    :return: bool
+    """
+    try:
+      self.s3.meta.client.head_object(Bucket=self.bucket, Key=s3_key)
+      return True
+    except ClientError as error:
+      if error.response['Error']['Code'] in ['404', 'NoSuchKey', 'NotFound']:
+        return False
+      raise
+
+  def existing_keys(self, prefix):
+    """
+    Return the keys of the objects under a prefix, listed with one call per 1000 objects
+    :param prefix: key prefix, e.g. the folder of a document's page images
+    :return: set of keys
+    """
+    keys = set()
+    paginator = self.s3.meta.client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+      keys.update(obj['Key'] for obj in page.get('Contents', []))
+    return keys
 
   def convert_to_png(self, path):
     """
@@ -54,6 +190,8 @@ class S3Uploader:
     :param path: path of the PDF file to convert
     :return: png_byte_list: list of each PNG image as bytes
     """
+    from pdf2image import convert_from_path
+
     images = convert_from_path(path, fmt='png')
     png_byte_list = []
 
@@ -65,14 +203,102 @@ class S3Uploader:
 
     return png_byte_list
 
-  def upload(self, png=False):
+  def upload_png_streaming(self, path, doc_name):
+    """
+    Render the PDF to PNG in page windows across a process pool and upload each page from a thread pool as soon as
+    it is rendered. Rendering of the next window waits while pages_in_flight pages are rendered but not uploaded yet.
+    Pages outside the page range are skipped, so no subset PDF is needed
+    :param path: path of the PDF file to convert
+    :param doc_name: name of the S3 folder for the images
+    :return: s3_keys: keys of the uploaded images in page order
+    """
+    from pdf2image import pdfinfo_from_path
+
+    if self.page_range is not None:
+      first_page, last_page = self.page_range
+    else:
+      first_page, last_page = 1, pdfinfo_from_path(path)['Pages']
+    windows = [(first, min(first + self.render_window - 1, last_page))
+               for first in range(first_page, last_page + 1, self.render_window)]
+    s3_keys = [doc_name + r'/' + str(index) + '.png' for index in range(last_page - first_page + 1)]
+
+    #Content addressed pages that are already in the bucket do not need to be rendered again
+    if self.content_addressed:
+      #One listing of the document's folder instead of a metadata call per page
+      existing = self.existing_keys(doc_name + '/')
+      missing_pages = set(page for page in range(first_page, last_page + 1)
+                          if s3_keys[page - first_page] not in existing)
+      windows = [(first, last) for first, last in windows
+                 if any(page in missing_pages for page in range(first, last + 1))]
+
+    in_flight = threading.Semaphore(self.pages_in_flight)
+    upload_futures = []
+    errors = []
+
+    def upload_page(s3_key, png_bytes):
+      try:
+        self.s3.meta.client.put_object(Body=png_bytes, Bucket=self.bucket, Key=s3_key)
+      finally:
+        in_flight.release()
+
+    def schedule_uploads(render_future, first, last, uploaders):
+      if render_future.exception() is not None:
+        errors.append(render_future.exception())
+        for _ in range(first, last + 1):
+          in_flight.release()
+        return
+      for page, png_bytes in zip(range(first, last + 1), render_future.result()):
+        upload_futures.append(uploaders.submit(upload_page, s3_keys[page - first_page], png_bytes))
+
+    with ThreadPoolExecutor(max_workers=self.upload_workers) as uploaders:
+      with ProcessPoolExecutor(max_workers=self.render_workers) as renderers:
+        for first, last in windows:
+          #Wait until enough rendered pages have been uploaded to render the next window
+          for _ in range(first, last + 1):
+            in_flight.acquire()
+          if errors:
+            break
+          render_future = renderers.submit(render_png_pages, path, first, last)
+          render_future.add_done_callback(
+            lambda future, first=first, last=last: schedule_uploads(future, first, last, uploaders))
+
+    if errors:
+      raise errors[0]
+    for future in upload_futures:
+      future.result()
+
+    return s3_keys
+
+  def upload(self, png=False, stream=True):
     """
     Upload to S3 bucket
-    :return:
+    :param png: upload every page as a PNG image instead of the PDF
+    :param stream: render and upload PNG pages concurrently instead of rendering the whole document first
+    :return: S3 key of the PDF, or list of S3 keys of the PNG images
     """
-    path, doc_name = self.get_document_name()
+    #Name objects after the content hash instead of the file name
+    if self.content_addressed:
+      doc_name = self.get_content_hash()
+    else:
+      doc_name = self.get_document_stem()
 
     #Uploads all PNG images into one folder in S3
+    if png and stream:
+      return self.upload_png_streaming(self.path, doc_name)
+
+    #A content addressed PDF that is already in the bucket costs a single metadata call
+    if not png and self.content_addressed and self.object_exists(doc_name + '.pdf'):
+      return doc_name + '.pdf'
+
+    #Stream the page subset to S3 from memory
+    if not png and self.in_memory and self.page_range is not None:
+      s3_key = doc_name + '.pdf'
+      with self.subset_to_buffer() as buffer:
+        self.s3.meta.client.upload_fileobj(Fileobj=buffer, Bucket=self.bucket, Key=s3_key, Config=self.transfer_config)
+      return s3_key
+
+    path, _ = self.get_document_name()
+
     if png:
       png_byte_list = self.convert_to_png(path)
       s3_keys = [] #keys for every image
@@ -80,13 +306,15 @@ class S3Uploader:
 
         s3_key = doc_name + r'/' + str(index) + '.png'
         s3_keys.append(s3_key)
+        if self.content_addressed and self.object_exists(s3_key):
+          continue
         self.s3.meta.client.put_object(Body=bytes, Bucket=self.bucket, Key=s3_key)
       return s3_keys
 
     #Upload PDF to bucket
     else:
       s3_key = doc_name + '.pdf'
-      self.s3.meta.client.upload_file(Filename=path, Bucket=self.bucket, Key=s3_key)
+      self.s3.meta.client.upload_file(Filename=path, Bucket=self.bucket, Key=s3_key, Config=self.transfer_config)
 
       return s3_key
 